@@ -0,0 +1,533 @@
+import os
+import sys
+import glob
+import gzip
+import json
+import shutil
+import sqlite3
+import hashlib
+import time
+import random
+import tracemalloc
+from typing import List
+
+from PIL import Image, ImageDraw
+
+from bms import BMS, TimingType, base36
+from bmsdrawer import BMSImage
+from bmslevel import InputTimeline, CalcDensity, DensityProfile, calc_levels, calc_levels_of_db
+from replay import ReplayData, BeatConvertedReplay, ReplayImage, Replay
+from bmscache import BMSCache
+from oradb import SongDB
+from render import render_many
+from tempomap import TempoMap
+from judge import ReplayJudge
+
+NOTE_CHANNELS = ( '11', '12', '13', '14', '15', '16', '18', '19' )
+LN_CHANNELS = ( '51', '52', '53', '54', '55', '56', '58', '59' )
+
+def generate_chart(lines: int, seed: int=0, resolution: int=16, wavs: int=1295, soflan: bool=True, bars: int=1000) -> List[str]:
+    """
+    generate synthetic BMS chart which has about `lines` lines.
+    """
+    rnd = random.Random(seed)
+    result = [
+        "#TITLE synthetic {}".format(lines),
+        "#GENRE benchmark",
+        "#BPM 150",
+        "#LNTYPE 1",
+        "#BPM01 200.5",
+        "#BPM02 75",
+        "#STOP01 96",
+    ]
+    for i in range(1, min(wavs, max(lines // 8, 1)) + 1):
+        result.append("#WAV{} {:04d}.wav".format(base36(i), i))
+
+    def make_data(slots) -> str:
+        data = ['00'] * resolution
+        for s in slots:
+            data[s] = base36(rnd.randint(1, min(wavs, 1295)))
+        return ''.join(data)
+
+    body_lines = max(lines - len(result), 1)
+    lines_per_bar = len(NOTE_CHANNELS) + 2
+    bar_count = min(max(body_lines // lines_per_bar, 1), bars)
+    repeat = max(body_lines // (bar_count * lines_per_bar), 1)
+    for number in range(bar_count):
+        if number % 16 == 15 and soflan:
+            result.append("#{:03d}02:0.75".format(number))
+        if number % 8 == 4 and soflan:
+            result.append("#{:03d}03:{}".format(number, "00" * (resolution // 2 - 1) + "B4" + "00" * (resolution // 2)))
+        if number % 8 == 6 and soflan:
+            result.append("#{:03d}08:{}".format(number, "01" + "00" * (resolution - 1)))
+        if number % 32 == 7 and soflan:
+            result.append("#{:03d}09:{}".format(number, "00" * (resolution // 4) + "01" + "00" * (resolution - resolution // 4 - 1)))
+        for r in range(repeat):
+            for channel in NOTE_CHANNELS:
+                slots = [s for s in range(r % 2, resolution, 2) if rnd.random() < 0.4]
+                result.append("#{:03d}{}:{}".format(number, channel, make_data(slots)))
+            result.append("#{:03d}01:{}".format(number, make_data([rnd.randrange(resolution)])))
+        if number % 4 == 1:
+            channel = LN_CHANNELS[rnd.randrange(1, len(LN_CHANNELS))]
+            result.append("#{:03d}{}:{}".format(number, channel, make_data([1, resolution - 1])))
+    return [x + "\n" for x in result]
+
+def generate_songdb(path: str, charts: List[str]) -> None:
+    """
+    write songdata.db which has `song` table of beatoraja for `charts`.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE song (md5 TEXT, sha256 TEXT, path TEXT)")
+    for chart in charts:
+        with open(chart, mode='rb') as f:
+            data = f.read()
+        db.execute("INSERT INTO song VALUES (?, ?, ?)",
+            (hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest(), chart))
+    db.commit()
+    db.close()
+
+def generate_replay(bms: BMS, path: str, seed: int=0, sha256: str='') -> None:
+    """
+    write synthetic replay which hits every note of `bms` with small offsets.
+    """
+    rnd = random.Random(seed)
+    timeline = InputTimeline(bms)
+    end = max([ max(x) for x in timeline.key_ms if len(x) > 0 ])
+    events = list()
+    for lane in range(8):
+        keycode = 7 if lane == 0 else lane - 1
+        ms = sorted(set([ int(x) + rnd.randint(-20, 20) for x in timeline.get_lane_timeline(lane) ]))
+        for i, m in enumerate(ms):
+            if m < 0 or m > end - 600:
+                continue
+            following = ms[i + 1] if i + 1 < len(ms) else m + 10000
+            hold = 300 if rnd.random() < 0.1 else 30
+            if following - m <= hold + 5:
+                hold = 10
+            events.append({ 'keycode': keycode, 'time': m, 'pressed': True })
+            events.append({ 'keycode': keycode, 'time': m + hold })
+    events.sort(key=lambda x: (x['time'], 'pressed' in x))
+    data = { 'sha256': sha256, 'randomoption': 0, 'pattern': [], 'keylog': events }
+    with gzip.open(path, mode='wt') as fp:
+        json.dump(data, fp)
+
+def generate_keylog(path: str, events: int, length: int, seed: int=0) -> None:
+    """
+    write synthetic replay which has `events` random key events in `length` ms.
+    """
+    rnd = random.Random(seed)
+    keylog = list()
+    for lane in range(8):
+        keycode = 7 if lane == 0 else lane - 1
+        pairs = events // 16
+        step = length // pairs
+        for i in range(pairs):
+            m = i * step + rnd.randrange(step // 2)
+            hold = rnd.choice((30, 80, 150, step // 3))
+            keylog.append({ 'keycode': keycode, 'time': m, 'pressed': True })
+            keylog.append({ 'keycode': keycode, 'time': m + hold })
+    keylog.sort(key=lambda x: (x['time'], 'pressed' in x))
+    data = { 'sha256': '', 'randomoption': 0, 'pattern': [], 'keylog': keylog }
+    with gzip.open(path, mode='wt') as fp:
+        json.dump(data, fp)
+
+def write_chart(path: str, lines: List[str]) -> None:
+    with open(path, mode='wt') as fp:
+        fp.writelines(lines)
+
+def measure(func, repeat: int=3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_parse(path_prefix: str="/tmp/oraplay_bench", sizes: List[int]=[100, 1000, 10000]) -> None:
+    print("parse time")
+    for size in sizes:
+        path = "{}_{}.bms".format(path_prefix, size)
+        lines = generate_chart(size)
+        write_chart(path, lines)
+        elapsed = measure(lambda: BMS(path))
+        print("  {:>6} lines : {:8.2f} ms ({:10.0f} lines/sec)".format(len(lines), elapsed * 1000, len(lines) / elapsed))
+
+def bench_lines(path: str="/tmp/oraplay_bench_lines.bms", size: int=20000) -> None:
+    print("line classification")
+    lines = generate_chart(size, seed=1, resolution=32)
+    write_chart(path, lines)
+    wavs = len([x for x in lines if x.startswith("#WAV")])
+    elapsed = measure(lambda: BMS(path))
+    print("  {} lines ({} #WAV) : {:10.0f} lines/sec".format(len(lines), wavs, len(lines) / elapsed))
+
+def bench_timing_type(path: str="/tmp/oraplay_bench_timing.bms", size: int=2000) -> None:
+    print("fraction timing vs tick timing")
+    write_chart(path, generate_chart(size, seed=2, soflan=False))
+    replay_path = path + ".gz"
+    generate_replay(BMS(path), replay_path)
+    replay = ReplayData(replay_path)
+
+    outputs = dict()
+    for timing_type in TimingType:
+        data = dict()
+        def parse():
+            data['bms'] = BMS(path, timing_type)
+        def convert():
+            data['convert'] = BeatConvertedReplay()
+            data['convert'].convert(data['bms'], replay)
+        def rate():
+            data['level'] = CalcDensity(data['bms']).calc()
+        def draw():
+            image = ReplayImage(data['bms'], data['convert'].bars)
+            image.draw()
+            data['image'] = image.image.tobytes()
+        times = [ measure(f) for f in (parse, convert, rate, draw) ]
+        print("  {:<8} : parse {:7.1f} ms, convert {:7.1f} ms, rate {:7.1f} ms, draw {:7.1f} ms".format(
+            timing_type.name, *[ x * 1000 for x in times ]))
+        outputs[timing_type] = (
+            [ [ [ b.to_fraction(n.timing) for n in lane ] for lane in b.notes ] for b in data['bms'].bars ],
+            data['level'],
+            data['image'],
+        )
+    assert outputs[TimingType.Fraction] == outputs[TimingType.Tick], 'outputs differ between timing types'
+    print("  outputs are identical")
+
+def bench_memory(path: str="/tmp/oraplay_bench_memory.bms", size: int=10000, charts: int=10) -> None:
+    print("memory of resident charts")
+    write_chart(path, generate_chart(size, seed=3))
+    for timing_type in TimingType:
+        tracemalloc.start()
+        resident = [ BMS(path, timing_type) for _ in range(charts) ]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        json.dumps(resident[0], cls=BMS.BMSDataJSONEncoder)
+        print("  {:<8} : {} charts of {} bars, current {:8.1f} MiB, peak {:8.1f} MiB".format(
+            timing_type.name, charts, len(resident[0].bars), current / 1024 / 1024, peak / 1024 / 1024))
+        del resident
+
+def bench_merge(path: str="/tmp/oraplay_bench_merge.bms", size: int=5000) -> None:
+    print("merge of repeated lane lines")
+    for resolution in (16, 192, 384):
+        lines = generate_chart(size, seed=4, resolution=resolution, bars=32)
+        write_chart(path, lines)
+        elapsed = measure(lambda: BMS(path))
+        print("  resolution {:>3}, {} lines in 32 bars : {:8.1f} ms".format(resolution, len(lines), elapsed * 1000))
+
+def bench_cache(directory: str="/tmp/oraplay_bench_cache", size: int=10000, replays: int=5) -> None:
+    print("Replay construction with chart cache")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    chart = os.path.join(directory, "chart.bms")
+    write_chart(chart, generate_chart(size, seed=5))
+    with open(chart, mode='rb') as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+    db = os.path.join(directory, "songdata.db")
+    generate_songdb(db, [ chart ])
+    replay_path = os.path.join(directory, "replay.gz")
+    generate_replay(BMS(chart), replay_path, sha256=sha256)
+
+    cache_directory = os.path.join(directory, "cache")
+    cold = measure(lambda: Replay(replay_path, db))
+    print("  no cache     : {:8.1f} ms".format(cold * 1000))
+    cache = BMSCache(cache_directory)
+    miss = measure(lambda: [ cache.clear(), Replay(replay_path, db, cache=cache) ])
+    print("  cold cache   : {:8.1f} ms".format(miss * 1000))
+    disk = measure(lambda: Replay(replay_path, db, cache=BMSCache(cache_directory)))
+    print("  warm disk    : {:8.1f} ms".format(disk * 1000))
+    memory = measure(lambda: [ Replay(replay_path, db, cache=cache) for _ in range(replays) ]) / replays
+    print("  warm memory  : {:8.1f} ms".format(memory * 1000))
+
+def bench_header(directory: str="/tmp/oraplay_bench_header", charts: int=20, size: int=5000) -> None:
+    print("header only vs full parse")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    paths = list()
+    for i in range(charts):
+        path = os.path.join(directory, "{:03d}.bms".format(i))
+        write_chart(path, generate_chart(size, seed=i))
+        paths.append(path)
+    full = measure(lambda: [ BMS(x) for x in paths ])
+    header = measure(lambda: [ BMS.read_header(x) for x in paths ])
+    lazy = measure(lambda: [ BMS(x, lazy=True) for x in paths ])
+    print("  full parse  : {:8.1f} ms ({:6.1f} charts/sec)".format(full * 1000, charts / full))
+    print("  read_header : {:8.1f} ms ({:6.1f} charts/sec)".format(header * 1000, charts / header))
+    print("  lazy BMS    : {:8.1f} ms ({:6.1f} charts/sec)".format(lazy * 1000, charts / lazy))
+
+def bench_convert(path: str="/tmp/oraplay_bench_convert.bms", size: int=5000) -> None:
+    print("replay conversion")
+    write_chart(path, generate_chart(size, seed=6, soflan=False))
+    bms = BMS(path)
+    replay_path = path + ".gz"
+    generate_replay(bms, replay_path)
+    replay = ReplayData(replay_path)
+    elapsed = measure(lambda: BeatConvertedReplay().convert(bms, replay), 1)
+    events = len(replay.get_keys())
+    print("  {} bars, {} key events : {:8.1f} ms ({:10.0f} events/sec)".format(
+        len(bms.bars), events, elapsed * 1000, events / elapsed))
+
+def bench_batch(path: str="/tmp/oraplay_bench_batch.bms", events: int=50000) -> None:
+    print("replay conversion, event by event vs batch")
+    write_chart(path, generate_chart(10000, seed=7, soflan=False))
+    bms = BMS(path)
+    replay_path = path + ".gz"
+    generate_keylog(replay_path, events, int(len(bms.bars) * 1600 * 0.9))
+    replay = ReplayData(replay_path)
+    outputs = list()
+    for name in ('convert', 'convert_batch'):
+        converted = BeatConvertedReplay()
+        elapsed = measure(lambda: getattr(converted, name)(bms, replay), 1)
+        print("  {:<13} : {} key events, {:8.1f} ms ({:10.0f} events/sec)".format(
+            name, events, elapsed * 1000, events / elapsed))
+        outputs.append(sorted([ (b.number, [ [ n.timing for n in lane ] for lane in b.notes ],
+            [ [ (type(n).__name__, getattr(n, 'timing', None), getattr(n, 'start', None), getattr(n, 'end', None)) for n in lane ] for lane in b.lnnotes ])
+            for b in converted.bars ], key=lambda x: x[0]))
+    assert outputs[0] == outputs[1], 'outputs differ between convert and convert_batch'
+    print("  outputs are identical")
+
+def bench_stream(path: str="/tmp/oraplay_bench_stream.gz", events: int=200000) -> None:
+    print("replay loading, json.load vs stream")
+    generate_keylog(path, events, events * 100)
+    for stream in (False, True):
+        tracemalloc.start()
+        replay = ReplayData(path, stream)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del replay
+        elapsed = measure(lambda: ReplayData(path, stream).get_key_arrays())
+        print("  stream={:<5} : {} key events, {:8.1f} ms, resident {:7.1f} MiB, peak {:7.1f} MiB".format(
+            str(stream), events, elapsed * 1000, current / 1024 / 1024, peak / 1024 / 1024))
+
+def bench_render(directory: str="/tmp/oraplay_bench_render", charts: int=4, replays: int=4, size: int=2000) -> None:
+    print("batch rendering of replays")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    paths = list()
+    for i in range(charts):
+        path = os.path.join(directory, "{:03d}.bms".format(i))
+        write_chart(path, generate_chart(size, seed=i, soflan=False))
+        paths.append(path)
+    db = os.path.join(directory, "songdata.db")
+    generate_songdb(db, paths)
+    replay_directory = os.path.join(directory, "replays")
+    os.makedirs(replay_directory)
+    os.makedirs(os.path.join(directory, "out"))
+    for path in paths:
+        with open(path, mode='rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        bms = BMS(path)
+        for i in range(replays):
+            generate_replay(bms, os.path.join(replay_directory, "{}-{}.gz".format(os.path.basename(path), i)), seed=i, sha256=sha256)
+
+    count = charts * replays
+    def one_by_one():
+        for path in sorted(glob.glob(os.path.join(replay_directory, "*.gz"))):
+            replay = Replay(path, db)
+            replay.draw_replay()
+            replay.image.save(os.path.join(directory, "out", os.path.basename(path) + ".png"))
+    elapsed = measure(one_by_one, 1)
+    print("  Replay one by one : {} replays of {} charts, {:8.1f} ms ({:6.2f} replays/sec)".format(
+        count, charts, elapsed * 1000, count / elapsed))
+    for workers in sorted(set([ 1, os.cpu_count() ])):
+        elapsed = measure(lambda: render_many([ replay_directory ], db, os.path.join(directory, "out"), workers), 1)
+        print("  {} workers         : {} replays of {} charts, {:8.1f} ms ({:6.2f} replays/sec)".format(
+            workers, count, charts, elapsed * 1000, count / elapsed))
+
+def bench_tempo(path: str="/tmp/oraplay_bench_tempo.bms", size: int=10000) -> None:
+    print("tempo map with BPM changes, STOPs and meter")
+    write_chart(path, generate_chart(size, seed=8))
+    bms = BMS(path)
+    build = measure(lambda: TempoMap(bms))
+    timeline = measure(lambda: InputTimeline(bms))
+    tempo = TempoMap.of(bms)
+    end = float(tempo.beat_to_ms(tempo.bar_start_beats[-1]))
+    ms = [ end * i / 100000 for i in range(100000) ]
+    array = measure(lambda: tempo.beat_to_ms_array(tempo.ms_to_beat_array(ms)))
+    print("  {} bars, {} segments : build {:7.1f} ms, InputTimeline {:7.1f} ms".format(
+        len(bms.bars), len(tempo.segments), build * 1000, timeline * 1000))
+    print("  ms -> beat -> ms of {} values as array : {:7.1f} ms".format(len(ms), array * 1000))
+
+def bench_judge(path: str="/tmp/oraplay_bench_judge.bms", size: int=10000) -> None:
+    print("judgement of replay")
+    write_chart(path, generate_chart(size, seed=9))
+    bms = BMS(path)
+    replay_path = path + ".gz"
+    generate_replay(bms, replay_path)
+    replay = ReplayData(replay_path)
+    result = dict()
+    def run():
+        result['judge'] = ReplayJudge(bms, replay).judge()
+    elapsed = measure(run)
+    events = len(replay.get_keys())
+    print("  {} notes, {} key events : {:8.1f} ms ({:10.0f} events/sec), EX score {}/{}".format(
+        len(result['judge'].notes), events, elapsed * 1000, events / elapsed,
+        result['judge'].ex_score(), result['judge'].max_ex_score()))
+
+def bench_tiles(path: str="/tmp/oraplay_bench_tiles.bms", size: int=5000) -> None:
+    print("drawing of replay image with density in tiles")
+    write_chart(path, generate_chart(size, seed=10))
+    bms = BMS(path)
+    replay_path = path + ".gz"
+    generate_replay(bms, replay_path)
+    replay = ReplayData(replay_path)
+    convert = BeatConvertedReplay()
+    convert.convert_batch(bms, replay)
+    density = DensityProfile(bms)
+    images = dict()
+    for workers in sorted(set([ 1, 2, os.cpu_count() ])):
+        def run():
+            image = ReplayImage(bms, convert.bars, density=density)
+            image.draw(modify=replay.get_pattern_modify(), workers=workers)
+            images[workers] = image
+        elapsed = measure(run, 1)
+        print("  {} workers : {} columns, {:8.1f} ms".format(workers, len(images[workers].canvas.barlist), elapsed * 1000))
+        assert images[workers].image.tobytes() == images[1].image.tobytes(), 'image of {} workers differs'.format(workers)
+    print("  images are identical")
+
+def bench_raster(path: str="/tmp/oraplay_bench_raster.bms", size: int=20000) -> None:
+    print("drawing of replay image by ImageDraw and by numpy buffer")
+    write_chart(path, generate_chart(size, seed=11))
+    bms = BMS(path)
+    replay_path = path + ".gz"
+    generate_replay(bms, replay_path)
+    replay = ReplayData(replay_path)
+    convert = BeatConvertedReplay()
+    convert.convert_batch(bms, replay)
+    density = DensityProfile(bms)
+    images = dict()
+    for batch in (False, True):
+        def run():
+            image = ReplayImage(bms, convert.bars, density=density)
+            image.draw(modify=replay.get_pattern_modify(), batch=batch)
+            images[batch] = image
+        elapsed = measure(run, 3)
+        print("  {:9} : {} notes, {:8.1f} ms".format("numpy" if batch is True else "ImageDraw", size, elapsed * 1000))
+    assert images[True].image.tobytes() == images[False].image.tobytes(), 'images differ between ImageDraw and numpy'
+    print("  images are identical")
+
+def bench_background(path: str="/tmp/oraplay_bench_background.bms", size: int=20000) -> None:
+    print("drawing of bar backgrounds, bar by bar and by cached strips")
+    write_chart(path, generate_chart(size, seed=12))
+    image = BMSImage(BMS(path))
+    image._calc_info_of_canvas()
+    lines = image.canvas.barlist
+    results = dict()
+    def by_bar():
+        result = Image.new("RGB", (image.canvas.width, image.canvas.height), (200, 200, 200))
+        dr = ImageDraw.Draw(result)
+        for i, line in enumerate(lines):
+            y = image.canvas.height - image.height_offset - 1
+            for b in line:
+                image._draw_bar_background(dr, image._column_x(i), y, int(image.bar_height * b.beat))
+                y -= int(image.bar_height * b.beat)
+        results['bar'] = result
+    def by_strip():
+        image._backgrounds = dict()
+        result = Image.new("RGB", (image.canvas.width, image.canvas.height), (200, 200, 200))
+        for i, line in enumerate(lines):
+            image._draw_line_background(result, line, image._column_x(i))
+        results['strip'] = result
+    for name, func in (('bar', by_bar), ('strip', by_strip)):
+        elapsed = measure(func, 3)
+        print("  {:5} : {} columns, {:8.1f} ms".format(name, len(lines), elapsed * 1000))
+    assert results['strip'].tobytes() == results['bar'].tobytes(), 'backgrounds differ between bars and strips'
+    print("  backgrounds are identical")
+
+def bench_level(directory: str="/tmp/oraplay_bench_level", charts: int=20, size: int=5000) -> None:
+    print("level calculation of a directory of charts")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    for i in range(charts):
+        write_chart(os.path.join(directory, "{:03d}.bms".format(i)), generate_chart(size, seed=i))
+    bms = BMS(os.path.join(directory, "000.bms"))
+    density = CalcDensity(bms)
+    timeline = measure(lambda: InputTimeline(bms))
+    calc = measure(density.calc)
+    print("  one chart  : InputTimeline {:7.1f} ms, calc {:7.2f} ms".format(timeline * 1000, calc * 1000))
+    results = list()
+    elapsed = measure(lambda: results.append(calc_levels([ directory ])), 1)
+    print("  calc_levels : {} charts, {:8.1f} ms ({:6.1f} charts/sec), {} failed".format(
+        charts, elapsed * 1000, charts / elapsed, len([ x for x in results[-1] if x.error is not None ])))
+
+def bench_profile(path: str="/tmp/oraplay_bench_profile.bms", size: int=20000) -> None:
+    print("density profile in sliding windows")
+    write_chart(path, generate_chart(size, seed=13))
+    bms = BMS(path)
+    InputTimeline(bms)
+    for window, hop in ((1000, 100), (1000, 10), (500, 1)):
+        profile = list()
+        elapsed = measure(lambda: profile.append(DensityProfile(bms, window, hop)))
+        peak = profile[-1].peak()
+        print("  window {:4} ms, hop {:3} ms : {:7} windows, {:7.1f} ms, peak {:5.1f} notes/sec, 95th {:5.1f} notes/sec".format(
+            window, hop, len(profile[-1].start), elapsed * 1000, peak[0], profile[-1].percentile(95)[0]))
+
+def bench_leveldb(directory: str="/tmp/oraplay_bench_leveldb", charts: int=40, size: int=3000) -> None:
+    print("level calculation of all charts in songdata.db")
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    paths = list()
+    for i in range(charts):
+        path = os.path.join(directory, "{:03d}.bms".format(i))
+        write_chart(path, generate_chart(size, seed=i))
+        paths.append(path)
+    db = os.path.join(directory, "songdata.db")
+    generate_songdb(db, paths)
+    output = os.path.join(directory, "levels.db")
+    for workers in sorted(set([ 1, os.cpu_count() ])):
+        elapsed = measure(lambda: [ os.path.exists(output) and os.remove(output), calc_levels_of_db(db, output, workers) ], 1)
+        print("  {} workers  : {} charts, {:8.1f} ms ({:6.1f} charts/sec)".format(workers, charts, elapsed * 1000, charts / elapsed))
+    elapsed = measure(lambda: calc_levels_of_db(db, output), 1)
+    print("  all cached : {} charts, {:8.1f} ms".format(charts, elapsed * 1000))
+
+def bench_songdb(path: str="/tmp/oraplay_bench_songdb.db", songs: int=20000, lookups: int=2000) -> None:
+    print("lookup of chart paths in songdata.db")
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE song (md5 TEXT, sha256 TEXT PRIMARY KEY, path TEXT)")
+    db.executemany("INSERT INTO song VALUES (?, ?, ?)", [ (hashlib.md5(str(i).encode()).hexdigest(),
+        hashlib.sha256(str(i).encode()).hexdigest(), "/songs/{}.bms".format(i)) for i in range(songs) ])
+    db.commit()
+    db.close()
+    rnd = random.Random(0)
+    hashes = [ hashlib.sha256(str(rnd.randrange(songs)).encode()).hexdigest() for _ in range(lookups) ]
+    song_db = SongDB.of(path)
+    each = measure(lambda: [ SongDB(path).get_file_path(x) for x in hashes ], 1)
+    shared = measure(lambda: [ song_db.get_file_path(x) for x in hashes ])
+    bulk = measure(lambda: song_db.get_file_paths(hashes))
+    print("  SongDB per lookup : {:8.1f} ms".format(each * 1000))
+    print("  shared SongDB     : {:8.1f} ms".format(shared * 1000))
+    paths = song_db.get_file_paths(hashes)
+    print("  get_file_paths    : {:8.1f} ms, same paths : {}".format(bulk * 1000,
+        all([ paths[x] == song_db.get_file_path(x) for x in hashes ])))
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'lines': bench_lines,
+    'timing': bench_timing_type,
+    'memory': bench_memory,
+    'merge': bench_merge,
+    'cache': bench_cache,
+    'header': bench_header,
+    'convert': bench_convert,
+    'batch': bench_batch,
+    'stream': bench_stream,
+    'render': bench_render,
+    'tempo': bench_tempo,
+    'judge': bench_judge,
+    'tiles': bench_tiles,
+    'raster': bench_raster,
+    'background': bench_background,
+    'level': bench_level,
+    'profile': bench_profile,
+    'leveldb': bench_leveldb,
+    'songdb': bench_songdb,
+}
+
+if __name__ == '__main__':
+    targets = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+    for t in targets:
+        BENCHMARKS[t]()
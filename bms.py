@@ -1,23 +1,70 @@
+import io
 import re
 import json
+import math
 
-from typing import List, Optional, Union
+from typing import BinaryIO, Iterable, TextIO, List, Optional, Set, Tuple, Union
 from fractions import Fraction
 from enum import Enum, auto
 
 from oraplayexceptions import InvalidFormat, __LINE__
 
-re_barbpm = re.compile(r"^#(?P<number>[0-9]{3})02:(?P<value>.+)")
-re_bar = re.compile(r"^#(?P<number>[0-9]{3})(?P<order>[0-9]{2}):(?P<value>([0-9A-Z]{2})+)")
-re_wav = re.compile(r"^#WAV(?P<order>[0-9A-Z]{2}) (?P<value>.+)")
-re_bpm = re.compile(r"^#BPM(?P<order>[0-9A-Z]{2}) (?P<value>.+)")
-re_stop = re.compile(r"^#STOP(?P<order>[0-9A-Z]{2}) (?P<value>.+)")
+# pairs of base-36 digits at the start of the value of channel, the rest is ignored
+re_channel_value = re.compile(r"(?:[0-9A-Z]{2})+")
+# positions after \n, \r\n and \r in str
+re_newline = re.compile(r"(?<=\n)|(?<=\r)(?!\n|\Z)")
+
+def base36(value: int) -> str:
+    """
+    2 digits of base 36, as definition numbers in BMS.
+    """
+    digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return digits[value // 36 % 36] + digits[value % 36]
+
+def split_command(line: str) -> Tuple[str, str]:
+    """
+    command and value of header line, separated by the first whitespace.
+    """
+    command, *value = line.split(None, 1)
+    return (command, value[0] if len(value) > 0 else '')
+
+def _read_chunks(stream: Union[BinaryIO, TextIO], chunk_size: int) -> Iterable[Union[bytes, str]]:
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def read_lines(stream: Union[BinaryIO, TextIO, Iterable[Union[bytes, str]]], chunk_size: int=1 << 16) -> Iterable[Union[bytes, str]]:
+    """
+    lines of stream split on \\n, \\r\\n and \\r like the text mode of open(), read in chunks.
+    an iterable of bytes or str is split in the same way.
+    """
+    chunks = _read_chunks(stream, chunk_size) if hasattr(stream, 'read') else stream
+    rest = None
+    for chunk in chunks:
+        if rest:
+            chunk = rest + chunk
+        if isinstance(chunk, str):
+            # str.splitlines splits on more characters than open()
+            lines = re_newline.split(chunk)
+        else:
+            lines = chunk.splitlines(keepends=True)
+        # the last line may go on in the next chunk, even after \r
+        rest = lines.pop() if len(lines) > 0 else None
+        yield from lines
+    if rest:
+        yield rest
 
 class LNType(Enum):
     LNTypeOne = auto()
     LNObj = auto()
     NoLN = auto()
 
+class TimingType(Enum):
+    Fraction = auto() # timing is Fraction in [0, 1]
+    Tick = auto()     # timing is int in [0, BarInfo.resolution]
+
 class ExBPMDef():
     def __init__(self):
         self.order = int()
@@ -34,6 +81,8 @@ class StopDef():
         self.value = int()
 
 class Note():
+    __slots__ = ('timing', 'defwav')
+
     def __init__(self, timing=Fraction(), defwav=int()):
         self.timing = timing
         self.defwav = defwav
@@ -42,9 +91,11 @@ class Note():
         return 'Note timing:{}, defwav:{}'.format(self.timing, self.defwav)
 
 class LNBase():
-    pass
+    __slots__ = ()
 
 class LNStart(LNBase):
+    __slots__ = ('timing', 'defwav')
+
     def __init__(self, timing=Fraction(), defwav=int()):
         self.timing = timing
         self.defwav = defwav
@@ -53,6 +104,8 @@ class LNStart(LNBase):
         return 'LNStart timing:{}, defwav:{}'.format(self.timing, self.defwav)
 
 class LNEnd(LNBase):
+    __slots__ = ('timing', 'defwav')
+
     def __init__(self, timing=Fraction(), defwav=int()):
         self.timing = timing
         self.defwav = defwav
@@ -61,6 +114,8 @@ class LNEnd(LNBase):
         return 'LNEnd timing:{}, defwav:{}'.format(self.timing, self.defwav)
 
 class LN(LNBase):
+    __slots__ = ('is_start', 'is_end', 'start', 'end')
+
     def __init__(self, is_start=False, is_end=False, start=Fraction(), end=Fraction()):
         self.is_start = is_start
         self.is_end = is_end
@@ -71,11 +126,15 @@ class LN(LNBase):
         return 'LN start:{}({}), end:{}({})'.format(self.start, self.is_start, self.end, self.is_end)
 
 class BpmNote():
+    __slots__ = ('timing', 'bpm')
+
     def __init__(self):
         self.timing = Fraction()
         self.bpm    = float()
 
 class StopNote():
+    __slots__ = ('timing', 'duration')
+
     def __init__(self):
         self.timing = Fraction()
         self.duration = Fraction()
@@ -84,17 +143,72 @@ class LNObj():
     def __init__(self, define: int=0):
         self.define = define
 
+# shared by blank bars until allocate() is called
+EMPTY_LANES = ( (), (), (), (), (), (), (), () )
+
 class BarInfo():
+    __slots__ = ('number', 'notes', 'lnnotes', 'background', 'bpm', 'stops', 'beat', 'resolution')
+
     def __init__(self):
         self.number        = int()
-        self.notes         = ( list(), list(), list(), list(), list(), list(), list(), list() )
-        self.lnnotes       = ( list(), list(), list(), list(), list(), list(), list(), list() )
-        self.background    = list() # List[Note]
-        self.bpm           = list() # List[BpmNote]
-        self.stops         = list() # List[StopNote]
+        self.notes         = EMPTY_LANES
+        self.lnnotes       = EMPTY_LANES
+        self.background    = () # List[Note]
+        self.bpm           = () # List[BpmNote]
+        self.stops         = () # List[StopNote]
         self.beat          = Fraction(1, 1)
+        self.resolution    = 1 # timing / resolution is the position in the bar
+
+    def is_allocated(self) -> bool:
+        # EMPTY_LANES is not identical after unpickling, so check the type
+        return isinstance(self.background, list)
+
+    def allocate(self) -> 'BarInfo':
+        """
+        allocate lists of notes. call before adding items to the bar.
+        """
+        if self.is_allocated() is False:
+            self.notes         = ( list(), list(), list(), list(), list(), list(), list(), list() )
+            self.lnnotes       = ( list(), list(), list(), list(), list(), list(), list(), list() )
+            self.background    = list()
+            self.bpm           = list()
+            self.stops         = list()
+        return self
+
+    def to_fraction(self, timing: Union[int, Fraction]) -> Fraction:
+        return Fraction(timing, self.resolution)
+
+    def to_ticks(self) -> None:
+        """
+        convert every timing in this bar to int ticks.
+        resolution becomes LCM of the denominators, so the conversion is exact.
+        """
+        assert self.resolution == 1, 'already converted to ticks'
+        positions = list() # List[Tuple[object, str]]
+        for lane in self.notes:
+            positions.extend([ (x, 'timing') for x in lane ])
+        for lane in self.lnnotes:
+            for x in lane:
+                if isinstance(x, LN):
+                    positions.append((x, 'start'))
+                    positions.append((x, 'end'))
+                else:
+                    positions.append((x, 'timing'))
+        positions.extend([ (x, 'timing') for x in self.background ])
+        positions.extend([ (x, 'timing') for x in self.bpm ])
+        positions.extend([ (x, 'timing') for x in self.stops ])
+
+        # LN timing may be int 0 or 1
+        values = [ getattr(obj, attr) for obj, attr in positions ]
+        values = [ (x, 1) if isinstance(x, int) else (x.numerator, x.denominator) for x in values ]
+        resolution = math.lcm(1, *set([ x[1] for x in values ]))
+        for (obj, attr), (numerator, denominator) in zip(positions, values):
+            setattr(obj, attr, numerator * (resolution // denominator))
+        self.resolution = resolution
 
     def sort(self):
+        if self.is_allocated() is False:
+            return
         sortkey = lambda x: x.timing
         self.notes[0].sort(key=sortkey)
         self.notes[1].sort(key=sortkey)
@@ -108,12 +222,135 @@ class BarInfo():
         self.stops.sort(key=sortkey)
 
 class LNInfo():
+    __slots__ = ('is_start', 'timing', 'number', 'defwav')
+
     def __init__(self):
         self.is_start = False
         self.timing = Fraction()
         self.number = int() # Bar Number Info
         self.defwav = int()
 
+class LineDecoder():
+    """
+    decode lines of BMS file.
+    the encoding is decided by the first non-ASCII line, UTF-8 if it is valid and CP932 otherwise.
+    """
+    ENCODINGS = ( 'utf-8', 'cp932' )
+
+    def __init__(self):
+        self.encoding = None
+
+    def strip_bom(self, line: Union[bytes, str]) -> Union[bytes, str]:
+        if isinstance(line, str):
+            return line[1:] if line.startswith('\ufeff') else line
+        if line.startswith(b'\xef\xbb\xbf'):
+            self.encoding = 'utf-8'
+            return line[3:]
+        return line
+
+    def decode(self, line: Union[bytes, str]) -> str:
+        if isinstance(line, str):
+            return line
+        if line.isascii():
+            return line.decode('ascii')
+        if self.encoding is not None:
+            try:
+                return line.decode(self.encoding)
+            except UnicodeDecodeError:
+                # fall back to the other encodings
+                pass
+        for encoding in self.ENCODINGS:
+            try:
+                result = line.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            if self.encoding is None:
+                self.encoding = encoding
+            return result
+        return line.decode(self.ENCODINGS[-1], errors='replace')
+
+class BMSHeader():
+    """
+    metadata of BMS read without building bars.
+    notes[lane] counts note objects which are not LN, lns[lane] counts LNs.
+    objects on the same timing of repeated channel lines are counted separately,
+    and a LNOBJ end makes the last open note of the lane a LN, or is ignored without one as in BMS.
+    """
+    NOTE_CHANNELS = { b'11': 1, b'12': 2, b'13': 3, b'14': 4, b'15': 5, b'16': 0, b'18': 6, b'19': 7 }
+    LN_CHANNELS = { b'51': 1, b'52': 2, b'53': 3, b'54': 4, b'55': 5, b'56': 0, b'58': 6, b'59': 7 }
+
+    def __init__(self):
+        self.title = str()
+        self.genre = str()
+        self.bpm = float()
+        self.lntype = LNType.LNTypeOne
+        self.lnobj = list() # List[int]
+        self.encoding = None
+        self.notes = [ 0, 0, 0, 0, 0, 0, 0, 0 ]
+        self.lns = [ 0, 0, 0, 0, 0, 0, 0, 0 ]
+
+    def total_notes(self) -> int:
+        return sum(self.notes) + sum(self.lns)
+
+    @classmethod
+    def from_stream(cls, stream: Union[BinaryIO, Iterable[bytes]]) -> 'BMSHeader':
+        header = cls()
+        decoder = LineDecoder()
+        lnobj = set() # Set[bytes], upper case
+        ln_objects = [ 0, 0, 0, 0, 0, 0, 0, 0 ]
+        for i, line in enumerate(read_lines(stream)):
+            if i == 0:
+                line = decoder.strip_bom(line)
+            if line[:1] != b'#':
+                continue
+
+            # channel line
+            if line[1:4].isdigit() and line[6:7] == b':':
+                data = line[7:].rstrip().upper()
+                pairs = [ data[x:x + 2] for x in range(0, len(data) - 1, 2) ]
+                lane = cls.LN_CHANNELS.get(line[4:6])
+                if lane is not None:
+                    ln_objects[lane] += len(pairs) - pairs.count(b'00')
+                    continue
+                lane = cls.NOTE_CHANNELS.get(line[4:6])
+                if lane is None:
+                    continue
+                if len(lnobj) == 0:
+                    header.notes[lane] += len(pairs) - pairs.count(b'00')
+                    continue
+                for pair in pairs:
+                    if pair == b'00':
+                        continue
+                    if pair in lnobj:
+                        # previous note becomes LN start
+                        if header.notes[lane] > 0:
+                            header.lns[lane] += 1
+                            header.notes[lane] -= 1
+                    else:
+                        header.notes[lane] += 1
+                continue
+
+            l = decoder.decode(line).rstrip()
+            command, value = split_command(l)
+            if command == '#TITLE':
+                header.title = value
+            elif command == '#GENRE':
+                header.genre = value
+            elif command == '#BPM':
+                header.bpm = float(value)
+            elif command == '#LNTYPE':
+                if value == '1':
+                    header.lntype = LNType.LNTypeOne
+            elif command == '#LNOBJ':
+                header.lnobj.append(int(value, 36))
+                lnobj.add(value.strip().upper().encode('ascii'))
+                header.lntype = LNType.LNObj
+
+        for lane in range(8):
+            header.lns[lane] += ln_objects[lane] // 2
+        header.encoding = decoder.encoding
+        return header
+
 class BMS():
 
     class BMSDataJSONEncoder(json.JSONEncoder):
@@ -136,6 +373,7 @@ class BMS():
                     'backgroud': obj.background,
                     'bpm': obj.bpm,
                     'beat': str(obj.beat),
+                    'resolution': obj.resolution,
                     'stop': obj.stops,
                     'notes_scratch': obj.notes[0],
                     'notes_one'    : obj.notes[1],
@@ -158,11 +396,110 @@ class BMS():
                 }
             return super(BMS.BMSDataJSONEncoder, self).default(obj)
 
-    def __init__(self, file: str):
-        with open(file) as f:
-            lines = f.readlines()
-
+    def __init__(self, file: str, timing_type: TimingType=TimingType.Fraction, lazy: bool=False):
+        """
+        if lazy is True, only the header is read here,
+        and definitions and bars are parsed when one of them is accessed first.
+        """
+        self.__initialize(timing_type)
+        self.__source = None
+        if lazy is True:
+            header = BMS.read_header(file)
+            self.title = header.title
+            self.genre = header.genre
+            self.bpm = header.bpm
+            self.lntype = header.lntype
+            self.encoding = header.encoding
+            self.__source = file
+            return
+        with open(file, mode='rb') as f:
+            self.__parse(read_lines(f))
+
+    @staticmethod
+    def read_header(file: str) -> BMSHeader:
+        with open(file, mode='rb') as f:
+            return BMSHeader.from_stream(f)
+
+    def __load(self) -> None:
+        # parse the file of lazy BMS
+        if self.__source is not None:
+            source = self.__source
+            self.__initialize(self.timing_type)
+            # properties used while parsing must not load the file again
+            self.__source = None
+            try:
+                with open(source, mode='rb') as f:
+                    self.__parse(read_lines(f))
+            except BaseException:
+                # parse again on the next access, not return partial data
+                self.__source = source
+                raise
+
+    @property
+    def bars(self) -> List[BarInfo]:
+        self.__load()
+        return self.__bars
+
+    @bars.setter
+    def bars(self, value: List[BarInfo]):
+        self.__bars = value
+
+    @property
+    def exbpm(self) -> List[ExBPMDef]:
+        self.__load()
+        return self.__exbpm
+
+    @exbpm.setter
+    def exbpm(self, value: List[ExBPMDef]):
+        self.__exbpm = value
+
+    @property
+    def wav(self) -> List[WavDef]:
+        self.__load()
+        return self.__wav
+
+    @wav.setter
+    def wav(self, value: List[WavDef]):
+        self.__wav = value
+
+    @property
+    def stop(self) -> List[StopDef]:
+        self.__load()
+        return self.__stop
+
+    @stop.setter
+    def stop(self, value: List[StopDef]):
+        self.__stop = value
+
+    @property
+    def lnobj(self) -> List[LNObj]:
+        self.__load()
+        return self.__lnobj
+
+    @lnobj.setter
+    def lnobj(self, value: List[LNObj]):
+        self.__lnobj = value
+
+    @classmethod
+    def from_stream(cls, stream: Union[BinaryIO, TextIO, Iterable[Union[bytes, str]]], timing_type: TimingType=TimingType.Fraction) -> 'BMS':
+        """
+        parse BMS from binary or text stream, or lines of bytes or str. lines are read one by one.
+        """
+        bms = cls.__new__(cls)
+        bms.__initialize(timing_type)
+        bms.__source = None
+        bms.__parse(read_lines(stream))
+        return bms
+
+    @classmethod
+    def from_bytes(cls, data: bytes, timing_type: TimingType=TimingType.Fraction) -> 'BMS':
+        return cls.from_stream(io.BytesIO(data), timing_type)
+
+    def __initialize(self, timing_type: TimingType):
+        self.encoding = None # detected encoding of non-ASCII lines
         self.lntype = LNType.LNTypeOne
+        self.timing_type = timing_type
+        self.tempo_map = None # TempoMap, made by TempoMap.of
         self.ln_info = ( LNInfo(), LNInfo(), LNInfo(), LNInfo(), LNInfo(), LNInfo(), LNInfo(), LNInfo() )
 
         self.title = str()
@@ -175,33 +512,67 @@ class BMS():
         self.stop = list() # List[StopDef]
         self.lnobj = list() # List[LNObj]
 
-        self.bars = list() # List[BarInfo]
+        # def indexed by base-36 order
+        self.__exbpm_table = dict() # Dict[int, ExBPMDef]
+        self.__wav_table = dict() # Dict[int, WavDef]
+        self.__stop_table = dict() # Dict[int, StopDef]
+        self.__lnobj_defines = set() # Set[int]
 
-        self.__parse(lines)
+        self.bars = list() # List[BarInfo]
+        self.__bar_index = dict() # Dict[int, BarInfo], used while parsing
+        self.__timings = dict() # Dict[Tuple[int, str, int], Set[timing]], used while parsing
 
     def __str__(self):
         pass
 
-    def __get_barinfo(self, number: int) -> BarInfo:
+    def get_exbpm(self, order: int) -> ExBPMDef:
+        self.__load()
         try:
-            i = next(filter(lambda x: x.number == number, self.bars))
-            return i
-        except StopIteration:
-            # no element
-            pass
-        bar = BarInfo()
-        bar.number = number
-        return bar
+            return self.__exbpm_table[order]
+        except KeyError:
+            raise InvalidFormat("#BPM{} is not defined".format(base36(order)), __LINE__())
+
+    def get_wav(self, order: int) -> WavDef:
+        self.__load()
+        try:
+            return self.__wav_table[order]
+        except KeyError:
+            raise InvalidFormat("#WAV{} is not defined".format(base36(order)), __LINE__())
 
-    def __set_barinfo(self, bar: BarInfo) -> None:
+    def get_stop(self, order: int) -> StopDef:
+        self.__load()
         try:
-            i = next(filter(lambda x: x[1].number == bar.number, enumerate(self.bars)))
-            self.bars[i[0]] = bar
+            return self.__stop_table[order]
+        except KeyError:
+            raise InvalidFormat("#STOP{} is not defined".format(base36(order)), __LINE__())
+
+    def __get_barinfo(self, number: int, allocate: bool=True) -> BarInfo:
+        """
+        bar of `number`, which is added if missing. lists of notes are not allocated without `allocate`.
+        """
+        bar = self.__bar_index.get(number)
+        if bar is None:
+            bar = BarInfo()
+            bar.number = number
+            self.__bar_index[number] = bar
+        if allocate is True:
+            bar.allocate()
+        return bar
+
+    def __materialize_bars(self) -> None:
+        # add blank bar
+        self.bars = list()
+        if len(self.__bar_index) == 0:
             return
-        except StopIteration:
-            #no element
-            pass
-        self.bars.append(bar)
+        for n in range(max(self.__bar_index.keys()) + 1):
+            bar = self.__bar_index.get(n)
+            if bar is None:
+                bar = BarInfo()
+                bar.number = n
+            bar.sort()
+            if self.timing_type == TimingType.Tick:
+                bar.to_ticks()
+            self.bars.append(bar)
 
     def __parse_note(self, data: str) -> Optional[List[Union[Note, LNEnd]]]:
         if not data:
@@ -214,16 +585,12 @@ class BMS():
             if s == '00':
                 continue
             define = int(s, 36)
-            is_ln = False
-            if self.lntype == LNType.LNObj:
-                for l in self.lnobj:
-                    if l.define == define:
-                        new_ln = LNEnd()
-                        new_ln.defwav = define
-                        new_ln.timing = Fraction(i, length)
-                        result.append(new_ln)
-                        is_ln = True
-            if is_ln is False:
+            if self.lntype == LNType.LNObj and define in self.__lnobj_defines:
+                new_ln = LNEnd()
+                new_ln.defwav = define
+                new_ln.timing = Fraction(i, length)
+                result.append(new_ln)
+            else:
                 new_note = Note()
                 new_note.defwav = define
                 new_note.timing = Fraction(i, length)
@@ -257,7 +624,7 @@ class BMS():
             if s == '00':
                 continue
             new_bpm = BpmNote()
-            new_bpm.bpm = next(filter(lambda x: x.order == int(s, 36), self.exbpm)).bpm
+            new_bpm.bpm = self.get_exbpm(int(s, 36)).bpm
             new_bpm.timing = Fraction(i, length)
             result.append(new_bpm)
         return result
@@ -273,7 +640,8 @@ class BMS():
             if s == '00':
                 continue
             new_stop = StopNote()
-            new_stop.duration = Fraction(next(filter(lambda x: x.order == int(s, 36), self.stop)).value, 192)
+            new_stop.timing = Fraction(i, length)
+            new_stop.duration = Fraction(self.get_stop(int(s, 36)).value, 192)
             result.append(new_stop)
         return result
 
@@ -331,269 +699,248 @@ class BMS():
             new_ln_line.end = 1
             target_ln_lane.append(new_ln_line)
 
-    def __convert_to_ln(self, src, dst, num, order):
-        b = list() # List[bool]
-        for i, s in enumerate(src):
-            if isinstance(s, LNEnd) is True:
-                b.append(False)
-                if i == 0:
-                    for j in range(num):
-                        before = self.__get_barinfo(num - j - 1)
-                        target_lane = before.notes[order]
-                        if len(target_lane) == 0:
-                            ln_mid = LN(False, False, 0, 1)
-                            before.lnnotes[order].append(ln_mid)
-                            continue
-                        target_note = target_lane[-1]
-                        ln_start = LNStart(target_note.timing, target_note.defwav)
-                        ln_mid = LN(True, False, target_note.timing, 1)
-                        before.lnnotes[order].extend([ ln_start, ln_mid ])
-                        target_lane = target_lane[:-1]
-                        before.notes[order].clear()
-                        before.notes[order].extend(target_lane)
-                        break
-                else:
-                    ln_start = LNStart(src[i-1].timing, src[i-1].defwav)
-                    ln_mid = LN(True, True, src[i-1].timing, s.timing)
-                    dst.extend([ ln_start, ln_mid, s ])
-                    b[i-1] = False
+    def __get_timings(self, number: int, name: str, lane: int=0) -> Set:
+        key = (number, name, lane)
+        try:
+            return self.__timings[key]
+        except KeyError:
+            # no element
+            pass
+        timings = set()
+        self.__timings[key] = timings
+        return timings
+
+    def __convert_to_ln_before(self, num, order) -> bool:
+        # LN starts in the previous bars
+        for j in range(num):
+            before = self.__get_barinfo(num - j - 1)
+            target_lane = before.notes[order]
+            if len(target_lane) == 0:
+                ln_mid = LN(False, False, 0, 1)
+                before.lnnotes[order].append(ln_mid)
+                continue
+            target_note = target_lane.pop()
+            self.__get_timings(before.number, 'notes', order).discard(target_note.timing)
+            ln_start = LNStart(target_note.timing, target_note.defwav)
+            ln_mid = LN(True, False, target_note.timing, 1)
+            before.lnnotes[order].extend([ ln_start, ln_mid ])
+            return True
+        return False
+
+    def __convert_to_ln(self, src, dst, num, order, start: int=0):
+        # items before start have been converted already
+        timings = self.__get_timings(num, 'notes', order)
+        removed = set() # Set[int], index of src
+        for i in range(start, len(src)):
+            s = src[i]
+            if isinstance(s, LNEnd) is False:
+                continue
+            removed.add(i)
+            timings.discard(s.timing)
+            if i == 0:
+                if self.__convert_to_ln_before(num, order):
+                    ln_mid = LN(False, True, 0, s.timing)
+                    dst.extend([ ln_mid, s ])
             else:
-                b.append(True)
+                ln_start = LNStart(src[i-1].timing, src[i-1].defwav)
+                ln_mid = LN(True, True, src[i-1].timing, s.timing)
+                dst.extend([ ln_start, ln_mid, s ])
+                removed.add(i - 1)
+                timings.discard(src[i-1].timing)
 
-        assert len(src) == len(b)
-        new_src = [x for i, x in enumerate(src) if b[i] is True]
-        src.clear()
-        src.extend(new_src)
+        if len(removed) == 0:
+            return
+        first = min(removed)
+        src[first:] = [x for i, x in enumerate(src[first:], first) if i not in removed]
 
     def __merge_item_with_ln(self, src: List[Union[Note, BpmNote, StopNote, LNEnd]], \
         dst: List[Union[Note, BpmNote, StopNote]], num, order, dst_ln: List[Union[LNBase]]=None):
-        for s in src:
-            found = False
-            for d in dst:
-                if d.timing == s.timing:
-                    found = True
-                    break
-            if not found:
-                dst.append(s)
+        start = len(dst)
+        self.__merge_item(src, dst, self.__get_timings(num, 'notes', order))
         if self.lntype == LNType.LNObj:
-            self.__convert_to_ln(dst, dst_ln, num, order)
+            self.__convert_to_ln(dst, dst_ln, num, order, start)
 
-    def __merge_item(self, src: List[Union[Note, BpmNote, StopNote, LNEnd]], dst: List[Union[Note, BpmNote, StopNote]]):
+    def __merge_item(self, src: List[Union[Note, BpmNote, StopNote, LNEnd]], dst: List[Union[Note, BpmNote, StopNote]], timings: Set):
         for s in src:
-            found = False
-            for d in dst:
-                if d.timing == s.timing:
-                    found = True
-                    break
-            if not found:
-                dst.append(s)
+            if s.timing in timings:
+                continue
+            timings.add(s.timing)
+            dst.append(s)
 
     def __merge_all_item(self, src: List[Note], dst: List[Note]):
         dst.extend(src)
 
-    def __parse(self, lines: List[str]):
-        for line in lines:
-            l = line.rstrip()
-
-            # not command
-            if not l.startswith("#"):
-                continue
-
-            if l.startswith("#TITLE"):
-                self.title = l[7:]
-                continue
+    def __parse_title(self, value: str):
+        self.title = value
+
+    def __parse_genre(self, value: str):
+        self.genre = value
+
+    def __parse_base_bpm(self, value: str):
+        self.bpm = float(value)
+
+    def __parse_lntype(self, value: str):
+        if value == '1':
+            self.lntype = LNType.LNTypeOne
+
+    def __parse_lnobj(self, value: str):
+        new_lnobj = LNObj(int(value, 36))
+        self.lnobj.append(new_lnobj)
+        self.__lnobj_defines.add(new_lnobj.define)
+        self.lntype = LNType.LNObj
+
+    def __parse_exbpm_def(self, order: str, value: str):
+        new_exbpm = ExBPMDef()
+        new_exbpm.order = int(order, 36)
+        new_exbpm.bpm = float(value)
+        self.exbpm.append(new_exbpm)
+        self.__exbpm_table.setdefault(new_exbpm.order, new_exbpm)
+
+    def __parse_wav_def(self, order: str, value: str):
+        new_wav = WavDef()
+        new_wav.order = int(order, 36)
+        new_wav.wav = value
+        self.wav.append(new_wav)
+        self.__wav_table.setdefault(new_wav.order, new_wav)
+
+    def __parse_stop_def(self, order: str, value: str):
+        new_stop = StopDef()
+        new_stop.order = int(order, 36)
+        new_stop.value = int(value)
+        self.stop.append(new_stop)
+        self.__stop_table.setdefault(new_stop.order, new_stop)
+
+    def __parse_channel_note(self, bar: BarInfo, lane: int, value: str):
+        notes = self.__parse_note(value)
+        if notes is None:
+            return
+        self.__merge_item_with_ln(notes, bar.notes[lane], bar.number, lane, bar.lnnotes[lane])
+
+    def __parse_channel_ln(self, bar: BarInfo, lane: int, value: str):
+        # LNTYPE 1
+        if self.lntype != LNType.LNTypeOne:
+            raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
+        notes = self.__parse_note(value)
+        if notes is None:
+            return
+        self.__generate_ln(lane, notes, bar)
 
-            if l.startswith("#GENRE"):
-                self.genre = l[7:]
-                continue
+    def __parse_channel_background(self, bar: BarInfo, lane: int, value: str):
+        notes = self.__parse_note(value)
+        if notes is None:
+            return
+        self.__merge_all_item(notes, bar.background)
 
-            if l.startswith("#BPM "):
-                self.bpm = float(l[5:])
-                continue
+    def __parse_channel_beat(self, bar: BarInfo, lane: int, value: str):
+        try:
+            bar.beat = Fraction(float(value))
+        except ValueError:
+            # empty or invalid meter is ignored
+            return
 
-            # LNTYPE
-            if l.startswith("#LNTYPE 1"):
-                self.lntype = LNType.LNTypeOne
-                continue
+    def __parse_channel_bpm(self, bar: BarInfo, lane: int, value: str):
+        bpms = self.__parse_bpm(value)
+        if bpms is None:
+            return
+        self.__merge_item(bpms, bar.bpm, self.__get_timings(bar.number, 'bpm'))
 
-            # LNOBJ
-            if l.startswith("#LNOBJ"):
-                self.lnobj.append(LNObj(int(l[7:], 36)))
-                self.lntype = LNType.LNObj
-                continue
+    def __parse_channel_exbpm(self, bar: BarInfo, lane: int, value: str):
+        bpms = self.__parse_exbpm(value)
+        if bpms is None:
+            return
+        self.__merge_item(bpms, bar.bpm, self.__get_timings(bar.number, 'bpm'))
 
-            m = re_bpm.match(l)
-            if m is not None:
-                new_exbpm = ExBPMDef()
-                new_exbpm.order = int(m.group('order'), 36)
-                new_exbpm.bpm = float(m.group('value'))
-                self.exbpm.append(new_exbpm)
-                continue
+    def __parse_channel_stop(self, bar: BarInfo, lane: int, value: str):
+        stops = self.__parse_stop(value)
+        if stops is None:
+            return
+        self.__merge_item(stops, bar.stops, self.__get_timings(bar.number, 'stops'))
+
+    # command -> handler
+    __header_table = {
+        '#TITLE' : __parse_title,
+        '#GENRE' : __parse_genre,
+        '#BPM'   : __parse_base_bpm,
+        '#LNTYPE': __parse_lntype,
+        '#LNOBJ' : __parse_lnobj,
+    }
+
+    # command without 2 digits definition number -> handler
+    __definition_table = {
+        '#BPM' : __parse_exbpm_def,
+        '#WAV' : __parse_wav_def,
+        '#STOP': __parse_stop_def,
+    }
+
+    # channel -> (handler, lane index)
+    __channel_table = {
+        '01': (__parse_channel_background, None),
+        '02': (__parse_channel_beat, None),
+        '03': (__parse_channel_bpm, None),
+        '08': (__parse_channel_exbpm, None),
+        '09': (__parse_channel_stop, None),
+        '11': (__parse_channel_note, 1),
+        '12': (__parse_channel_note, 2),
+        '13': (__parse_channel_note, 3),
+        '14': (__parse_channel_note, 4),
+        '15': (__parse_channel_note, 5),
+        '16': (__parse_channel_note, 0),
+        '18': (__parse_channel_note, 6),
+        '19': (__parse_channel_note, 7),
+        '51': (__parse_channel_ln, 1),
+        '52': (__parse_channel_ln, 2),
+        '53': (__parse_channel_ln, 3),
+        '54': (__parse_channel_ln, 4),
+        '55': (__parse_channel_ln, 5),
+        '56': (__parse_channel_ln, 0),
+        '58': (__parse_channel_ln, 6),
+        '59': (__parse_channel_ln, 7),
+    }
+
+    def __parse_line(self, l: str):
+        # channel line, '#nnnCC:value'
+        if l[1:4].isdigit() and l[6:7] == ':':
+            try:
+                handler, lane = self.__channel_table[l[4:6]]
+            except KeyError:
+                # unsupported channel, only the bar is added
+                if l[4:6].isdigit() and re_channel_value.match(l[7:]) is not None:
+                    self.__get_barinfo(int(l[1:4]), allocate=False)
+                return
+            value = l[7:]
+            if handler is not BMS.__parse_channel_beat:
+                m = re_channel_value.match(value)
+                if m is None:
+                    return
+                value = m.group()
+            handler(self, self.__get_barinfo(int(l[1:4])), lane, value)
+            return
 
-            m = re_wav.match(l)
-            if m is not None:
-                new_wav = WavDef()
-                new_wav.order = int(m.group('order'), 36)
-                new_wav.wav = m.group('value')
-                self.wav.append(new_wav)
-                continue
+        # header line, '#COMMAND value'
+        command, value = split_command(l)
+        handler = self.__header_table.get(command)
+        if handler is not None:
+            handler(self, value)
+            return
+        handler = self.__definition_table.get(command[:-2])
+        if handler is not None and value:
+            handler(self, command[-2:], value)
 
-            m = re_stop.match(l)
-            if m is not None:
-                new_stop = StopDef()
-                new_stop.order = int(m.group('order'), 36)
-                new_stop.value = int(m.group('value'))
-                self.stop.append(new_stop)
-                continue
+    def __parse(self, lines: Iterable[Union[bytes, str]]):
+        decoder = LineDecoder()
+        for i, line in enumerate(lines):
+            if i == 0:
+                line = decoder.strip_bom(line)
 
-            m = re_barbpm.match(l)
-            if m is not None:
-                bar = self.__get_barinfo(int(m.group('number')))
-                bar.beat = Fraction(float(m.group('value')))
-                self.__set_barinfo(bar)
+            # not command
+            if line[:1] not in (b'#', '#'):
                 continue
 
-            m = re_bar.match(l)
-            if m is not None:
-                bar = self.__get_barinfo(int(m.group('number')))
-                order = m.group('order')
+            self.__parse_line(decoder.decode(line).rstrip())
 
-                if order == '11':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[1], bar.number, 1, bar.lnnotes[1])
-                elif order == '12':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[2], bar.number, 2, bar.lnnotes[2])
-                elif order == '13':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[3], bar.number, 3, bar.lnnotes[3])
-                elif order == '14':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[4], bar.number, 4, bar.lnnotes[4])
-                elif order == '15':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[5], bar.number, 5, bar.lnnotes[5])
-                elif order == '16':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[0], bar.number, 0, bar.lnnotes[0])
-                elif order == '18':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[6], bar.number, 6, bar.lnnotes[6])
-                elif order == '19':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item_with_ln(value, bar.notes[7], bar.number, 7, bar.lnnotes[7])
-                elif order == '01':
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_all_item(value, bar.background)
-                elif order == '03':
-                    value = self.__parse_bpm(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item(value, bar.bpm)
-                elif order == '08':
-                    value = self.__parse_exbpm(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item(value, bar.bpm)
-                elif order == '09':
-                    value = self.__parse_stop(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__merge_item(value, bar.stops)
-
-                # LNTYPE 1
-                elif order == '51':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(1, value, bar)
-                elif order == '52':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(2, value, bar)
-                elif order == '53':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(3, value, bar)
-                elif order == '54':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(4, value, bar)
-                elif order == '55':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(5, value, bar)
-                elif order == '56':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(0, value, bar)
-                elif order == '58':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(6, value, bar)
-                elif order == '59':
-                    if self.lntype != LNType.LNTypeOne:
-                        raise InvalidFormat("using LN lane without '#LNTYPE 1'", __LINE__())
-                    value = self.__parse_note(m.group('value'))
-                    if value is None:
-                        continue
-                    self.__generate_ln(7, value, bar)
-
-                self.__set_barinfo(bar)
-
-        for b in self.bars:
-            b.sort()
-
-        # add blank bar
-        blank_number = list()
-        for i in range(len(self.bars)):
-            try:
-                b = next(filter(lambda x: x.number == i, self.bars))
-            except StopIteration:
-                blank_number.append(i)
-
-        for n in blank_number:
-            new_item = BarInfo()
-            new_item.number = n
-            self.bars.insert(n, new_item)
+        self.encoding = decoder.encoding
+        self.__materialize_bars()
+        self.__timings.clear()
 
     def output_json(self, path):
         with open(path, mode='wt') as fp:
@@ -0,0 +1,131 @@
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+from bms import BMS, TimingType
+from oradb import HashType
+from oraplayexceptions import ArgumentError, __LINE__
+
+CACHE_VERSION = 5
+
+def file_hash(path: str, hash_type: HashType=HashType.sha256) -> str:
+    if hash_type == HashType.sha256:
+        h = hashlib.sha256()
+    elif hash_type == HashType.md5:
+        h = hashlib.md5()
+    else:
+        raise ArgumentError("hash type is invalid", __LINE__())
+    with open(path, mode='rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+class BMSCache():
+    """
+    cache of parsed BMS.
+    parsed charts are kept in memory (LRU) and pickled into `directory`.
+    a cache entry is keyed by hash of the chart and is valid while mtime and size of the file are same.
+    returned BMS is shared between callers, so do not modify it.
+    """
+    def __init__(self, directory: Optional[str]=None, capacity: int=32):
+        self.directory = directory
+        self.capacity = capacity
+        self.memory = OrderedDict() # OrderedDict[str, Tuple[Tuple[int, int], BMS]]
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def __key(self, hash: str, hash_type: HashType, timing_type: TimingType) -> str:
+        return "{}-{}-{}".format(hash_type.name, hash.lower(), timing_type.name.lower())
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pickle")
+
+    def __stamp(self, path: str):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def __remember(self, key: str, stamp, bms: BMS) -> None:
+        self.memory[key] = (stamp, bms)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def __load(self, key: str, stamp) -> Optional[BMS]:
+        if self.directory is None:
+            return None
+        try:
+            with open(self.__path(key), mode='rb') as f:
+                version, cached_stamp, bms = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError, ImportError):
+            # no entry or broken entry
+            return None
+        if version != CACHE_VERSION or cached_stamp != stamp:
+            return None
+        return bms
+
+    def __store(self, key: str, stamp, bms: BMS) -> None:
+        if self.directory is None:
+            return
+        path = self.__path(key)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temp, mode='wb') as f:
+                pickle.dump((CACHE_VERSION, stamp, bms), f, protocol=5)
+            os.replace(temp, path)
+        except BaseException:
+            # do not leave a partial file in the cache directory
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def get(self, path: str, hash: Optional[str]=None, hash_type: HashType=HashType.sha256,
+        timing_type: TimingType=TimingType.Fraction) -> BMS:
+        """
+        return parsed BMS of `path`. hash is calculated from the file when it is omitted.
+        """
+        if hash is None:
+            hash = file_hash(path, hash_type)
+        key = self.__key(hash, hash_type, timing_type)
+        stamp = self.__stamp(path)
+
+        try:
+            cached_stamp, bms = self.memory[key]
+            if cached_stamp == stamp:
+                self.memory.move_to_end(key)
+                return bms
+        except KeyError:
+            # no element
+            pass
+
+        bms = self.__load(key, stamp)
+        if bms is None:
+            bms = BMS(path, timing_type)
+            self.__store(key, stamp, bms)
+        self.__remember(key, stamp, bms)
+        return bms
+
+    def invalidate(self, hash: str, hash_type: HashType=HashType.sha256) -> None:
+        """
+        remove every entry of the chart from memory and disk.
+        """
+        for timing_type in TimingType:
+            key = self.__key(hash, hash_type, timing_type)
+            self.memory.pop(key, None)
+            if self.directory is None:
+                continue
+            try:
+                os.remove(self.__path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        """
+        remove all entries from memory and disk.
+        """
+        self.memory.clear()
+        if self.directory is None:
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".pickle"):
+                os.remove(os.path.join(self.directory, name))
@@ -1,8 +1,14 @@
+import os
+import math
+
 from PIL import Image, ImageDraw
 from enum import Enum, auto
 from abc import ABCMeta, abstractmethod
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from copy import copy
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 import bms
 from oraplayexceptions import UnsupportedType, ArgumentError, __LINE__
@@ -12,6 +18,7 @@ COLOR_WHITE = (255, 255, 255)
 COLOR_YELLOW = (255, 255, 0)
 COLOR_RED = (255, 0, 0)
 COLOR_BLUE = (0, 0, 255)
+COLOR_ORANGE = (255, 128, 0)
 
 class KeyMode(Enum):
     mode7key = auto()
@@ -69,7 +76,7 @@ class BarImage():
 
         def __draw_notes(note, order, x, color):
             x_end = x + self.keysize.get_widths()[order] - 1
-            y_start = image_height - int(note.timing * image_height) - self.keysize.get_height() - 1
+            y_start = image_height - note.timing * image_height // data.resolution - self.keysize.get_height() - 1
             y_end = y_start + self.keysize.get_height()
             drawer.rectangle((x, y_start, x_end, y_end), fill=color)
 
@@ -96,11 +103,278 @@ class Canvas():
         self.height = height
         self.barlist = barlist
 
+class ArrayCanvas():
+    """
+    RGB image buffer of numpy, which draws many rectangles at once in the same pixels as ImageDraw.
+    a pixel is a little endian uint32 of RGBX, so a color is filled as one value.
+    rectangles and lines are queued and painted by flush(), layer by layer in ascending `seq`, and in the order of the calls
+    for the same `seq`.
+    texts are drawn by ImageDraw over the buffer in image().
+    """
+    # rectangles larger than this on average are painted one by one
+    SLICE_PIXELS = 1024
+    # width of a band of the image painted at once
+    BAND_WIDTH = 2048
+
+    def __init__(self, width: int, height: int, color: Tuple[int, int, int]):
+        self.width = width
+        self.height = height
+        self.buffer = np.full((height, width), ArrayCanvas.pack(color), dtype='<u4')
+        self.__queue = list() # List[Tuple[np.ndarray, ...]], (x0, y0, x1, y1, color, seq, layer)
+        self.__layer = 0
+        self.__texts = list() # List[Tuple[tuple, dict]]
+
+    @staticmethod
+    def pack(color) -> np.ndarray:
+        """
+        RGB tuple or array of them to RGBX values.
+        """
+        color = np.asarray(color, dtype=np.uint32).reshape(-1, 3)
+        return color[:, 0] | (color[:, 1] << 8) | (color[:, 2] << 16)
+
+    def rectangles(self, x0, y0, x1, y1, color, seq) -> None:
+        """
+        filled rectangles like ImageDraw.rectangle((x0, y0, x1, y1), fill=color).
+        `color` is a RGB tuple or an array of them.
+        """
+        x0, y0, x1, y1, seq = [ x.ravel() for x in np.broadcast_arrays(*[ np.asarray(x, dtype=np.int64) for x in (x0, y0, x1, y1, seq) ]) ]
+        color = np.broadcast_to(ArrayCanvas.pack(color), x0.shape)
+        self.__queue.append((x0, y0, x1, y1, color, seq, np.full(len(x0), self.__layer)))
+
+    def lines(self, x0, y0, x1, y1, color, width: int, seq) -> None:
+        """
+        horizontal (y0 == y1) or vertical (x0 == x1) lines like ImageDraw.line((x0, y0, x1, y1), fill=color, width=width),
+        drawn from left to right or from top to bottom.
+        """
+        x0, y0, x1, y1, seq = np.broadcast_arrays(*[ np.asarray(x, dtype=np.int64) for x in (x0, y0, x1, y1, seq) ])
+        vertical = x0 == x1
+        point = vertical & (y0 == y1)
+        lo = (width - 1) // 2
+        hi = width // 2
+        # a wide line of no length is a point
+        self.rectangles(np.where(vertical & ~point, x0 - lo, x0), np.where(vertical, y0, y0 - lo),
+            np.where(vertical & ~point, x1 + hi, x1), np.where(vertical | point, y1, y1 + hi), color, seq)
+
+    def outlines(self, x0, y0, x1, y1, color, width: int, seq) -> None:
+        """
+        outlines of rectangles like ImageDraw.rectangle((x0, y0, x1, y1), outline=color, width=width).
+        """
+        x0, y0, x1, y1 = [ np.asarray(x, dtype=np.int64) for x in (x0, y0, x1, y1) ]
+        self.rectangles(x0, y0, x1, y0 + width - 1, color, seq)
+        self.rectangles(x0, y1 - width + 1, x1, y1, color, seq)
+        self.rectangles(x0, y0, x0 + width - 1, y1, color, seq)
+        self.rectangles(x1 - width + 1, y0, x1, y1, color, seq)
+
+    def next_layer(self) -> None:
+        """
+        rectangles queued after this are painted over those queued before.
+        """
+        self.__layer += 1
+
+    def text(self, *args, **kwargs) -> None:
+        """
+        same as ImageDraw.text.
+        """
+        self.__texts.append((args, kwargs))
+
+    def flush(self) -> None:
+        if len(self.__queue) == 0:
+            return
+        x0, y0, x1, y1, color, seq, layer = [ np.concatenate(x) for x in zip(*self.__queue) ]
+        self.__queue = list()
+
+        x0 = np.maximum(x0, 0)
+        y0 = np.maximum(y0, 0)
+        x1 = np.minimum(x1, self.width - 1)
+        y1 = np.minimum(y1, self.height - 1)
+        order = np.lexsort((seq, layer))
+        order = order[(x0[order] <= x1[order]) & (y0[order] <= y1[order])]
+        if len(order) == 0:
+            return
+        x0, y0, x1, y1, color = x0[order], y0[order], x1[order], y1[order], color[order]
+
+        areas = (x1 - x0 + 1) * (y1 - y0 + 1)
+        if areas.sum() >= len(x0) * ArrayCanvas.SLICE_PIXELS:
+            for r in range(len(x0)):
+                self.buffer[y0[r]:y1[r] + 1, x0[r]:x1[r] + 1] = color[r]
+            return
+
+        # in bands to keep the map of rectangles small
+        for band in range(x0.min() // ArrayCanvas.BAND_WIDTH, x1.max() // ArrayCanvas.BAND_WIDTH + 1):
+            band_left = band * ArrayCanvas.BAND_WIDTH
+            band_right = band_left + ArrayCanvas.BAND_WIDTH - 1
+            inside = (x0 <= band_right) & (x1 >= band_left)
+            if np.any(inside):
+                self.__paint(np.maximum(x0[inside], band_left), y0[inside], np.minimum(x1[inside], band_right), y1[inside],
+                    color[inside])
+
+    def __paint(self, x0: np.ndarray, y0: np.ndarray, x1: np.ndarray, y1: np.ndarray, color: np.ndarray) -> None:
+        # map of the last rectangle on every pixel
+        left, top = x0.min(), y0.min()
+        region_width = x1.max() - left + 1
+        region_height = y1.max() - top + 1
+        widths = x1 - x0 + 1
+        heights = y1 - y0 + 1
+        last = np.zeros((region_height, region_width), dtype=np.int32) # 1 + index of rectangle, 0 for none
+
+        # large rectangles one by one
+        large = np.flatnonzero(widths * heights >= ArrayCanvas.SLICE_PIXELS).tolist()
+        for r in large:
+            view = last[y0[r] - top:y1[r] - top + 1, x0[r] - left:x1[r] - left + 1]
+            np.maximum(view, r + 1, out=view)
+
+        # and small rectangles of the same shape at once
+        small = np.flatnonzero(widths * heights < ArrayCanvas.SLICE_PIXELS)
+        origin = (y0[small] - top) * region_width + x0[small] - left
+        shapes, shape_index = np.unique(widths[small] * (self.height + 1) + heights[small], return_inverse=True)
+        flat = last.reshape(-1)
+        pixels = list() # List[Tuple[np.ndarray, np.ndarray]], pixels in `last` and in the buffer
+        for i, shape in enumerate(shapes.tolist()):
+            owner = np.flatnonzero(shape_index == i)
+            width, height = divmod(shape, self.height + 1)
+            dy, dx = np.arange(height)[:, None], np.arange(width)[None, :]
+            local = (origin[owner][:, None] + (dy * region_width + dx).ravel()[None, :]).ravel()
+            np.maximum.at(flat, local, np.repeat(small[owner].astype(np.int32) + 1, height * width))
+            pixels.append((local, (y0[small[owner]] * self.width + x0[small[owner]])[:, None] + (dy * self.width + dx).ravel()[None, :]))
+
+        # paint only the pixels of the rectangles
+        for r in large:
+            self.buffer[y0[r]:y1[r] + 1, x0[r]:x1[r] + 1] = \
+                color[last[y0[r] - top:y1[r] - top + 1, x0[r] - left:x1[r] - left + 1] - 1]
+        buffer = self.buffer.reshape(-1)
+        for local, target in pixels:
+            buffer[target.ravel()] = color[flat[local] - 1]
+
+    def image(self) -> Image.Image:
+        self.flush()
+        image = Image.frombytes("RGB", (self.width, self.height), self.buffer, "raw", "RGBX")
+        if len(self.__texts) > 0:
+            dr = ImageDraw.Draw(image)
+            for args, kwargs in self.__texts:
+                dr.text(*args, **kwargs)
+        return image
+
+class NoteArray():
+    """
+    notes of bars as arrays, in the order of drawing by NoteDrawer.
+    """
+    NOTE = 0
+    LN_START = 1
+    LN_END = 2
+    LN = 3
+
+    def __init__(self, bars: List[Tuple[bms.BarInfo, int, int, int]], x: List[int], lanes: List[int], bpm: bool=False):
+        """
+        `bars` is a list of (bar, height, top, left), and the note of lane `lanes[i]` is drawn at left + `x[i]` as order i.
+        BPM changes are listed too with `bpm`.
+        """
+        kind = list()
+        order = list()
+        y = list() # index of timing, of the end of LN
+        y_start = list() # index of timing of the start of LN, -1 for others
+        is_start = list()
+        is_end = list()
+        seq = list() # order of drawing, 2 for each
+        left = list()
+        bpm_x = list()
+        bpm_y = list() # index of timing
+        bpm_seq = list()
+        timings = list()
+        timing_count = list() # number of timings of each bar
+
+        count = 0
+        for bar, height, top, bar_left in bars:
+            first = len(timings)
+            if bpm is True:
+                for b in bar.bpm:
+                    bpm_x.append(bar_left)
+                    bpm_y.append(len(timings))
+                    bpm_seq.append(count)
+                    timings.append(b.timing)
+                    count += 2
+            for i, m in enumerate(lanes):
+                notes = bar.notes[m]
+                lnnotes = bar.lnnotes[m]
+                length = len(notes) + len(lnnotes)
+                if length == 0:
+                    continue
+                kind.extend([ NoteArray.NOTE ] * len(notes))
+                y.extend(range(len(timings), len(timings) + len(notes)))
+                timings.extend([ n.timing for n in notes ])
+                y_start.extend([ -1 ] * len(notes))
+                is_start.extend([ False ] * len(notes))
+                is_end.extend([ False ] * len(notes))
+                for n in lnnotes:
+                    if isinstance(n, bms.LN):
+                        kind.append(NoteArray.LN)
+                        y.append(len(timings))
+                        y_start.append(len(timings) + 1)
+                        timings.append(n.end)
+                        timings.append(n.start)
+                        is_start.append(n.is_start)
+                        is_end.append(n.is_end)
+                    else:
+                        kind.append(NoteArray.LN_START if isinstance(n, bms.LNStart) else NoteArray.LN_END)
+                        y.append(len(timings))
+                        timings.append(n.timing)
+                        y_start.append(-1)
+                        is_start.append(False)
+                        is_end.append(False)
+                order.extend([ i ] * length)
+                left.extend([ bar_left ] * length)
+                seq.extend(range(count, count + 2 * length, 2))
+                count += 2 * length
+            timing_count.append(len(timings) - first)
+
+        offsets = NoteArray.__offsets(timings, timing_count, bars)
+        y_start = np.asarray(y_start, dtype=np.int64)
+
+        self.kind = np.asarray(kind, dtype=np.int8)
+        self.order = np.asarray(order, dtype=np.int64)
+        self.x = np.asarray(left, dtype=np.int64) + np.asarray(x, dtype=np.int64)[self.order]
+        self.y = offsets[np.asarray(y, dtype=np.int64)]
+        self.y_start = np.where(y_start < 0, 0, offsets[np.maximum(y_start, 0)])
+        self.is_start = np.asarray(is_start, dtype=bool)
+        self.is_end = np.asarray(is_end, dtype=bool)
+        self.seq = np.asarray(seq, dtype=np.int64)
+        self.bpm_x = np.asarray(bpm_x, dtype=np.int64)
+        self.bpm_y = offsets[np.asarray(bpm_y, dtype=np.int64)] - 1
+        self.bpm_seq = np.asarray(bpm_seq, dtype=np.int64)
+
+    @staticmethod
+    def __offsets(timings: List, timing_count: List[int], bars: List[Tuple[bms.BarInfo, int, int, int]]) -> np.ndarray:
+        """
+        top + (resolution - timing) * height // resolution of each timing, without Fraction.
+        """
+        resolution = [ bar.resolution for bar, height, top, left in bars ]
+        height = [ height for bar, height, top, left in bars ]
+        top = [ top for bar, height, top, left in bars ]
+        numerator = [ t.numerator for t in timings ]
+        denominator = [ t.denominator for t in timings ]
+        if len(timings) == 0:
+            return np.zeros(1, dtype=np.int64)
+
+        if max(denominator) * max(resolution) * (max(height) + 1) < 2 ** 62:
+            q = np.repeat(np.asarray(resolution, dtype=np.int64), timing_count)
+            h = np.repeat(np.asarray(height, dtype=np.int64), timing_count)
+            p = q * np.asarray(numerator, dtype=np.int64)
+            q *= np.asarray(denominator, dtype=np.int64)
+            return np.repeat(np.asarray(top, dtype=np.int64), timing_count) + (q - p) * h // q
+
+        # too large for int64
+        offsets = list()
+        for r, h, t, n in zip(resolution, height, top, timing_count):
+            for i in range(len(offsets), len(offsets) + n):
+                q = r * denominator[i]
+                offsets.append(t + (q - r * numerator[i]) * h // q)
+        return np.asarray(offsets, dtype=np.int64)
+
 class NoteDrawer():
     def __init__(self, bar_height: int, key_size: KeySize=ModeSevenKeySize(),
         color: List=( COLOR_RED, COLOR_WHITE, COLOR_BLUE, COLOR_WHITE, COLOR_BLUE, COLOR_WHITE, COLOR_BLUE, COLOR_WHITE )):
         self.drawer = None
         self.bar_height = bar_height
+        self.resolution = 1
         self.key_size = key_size
         self.color = color
 
@@ -110,10 +384,17 @@ class NoteDrawer():
     def set_height(self, height):
         self.bar_height = height
 
+    def set_resolution(self, resolution):
+        self.resolution = resolution
+
+    def __offset(self, timing):
+        # distance from the top of the bar
+        return (self.resolution - timing) * self.bar_height // self.resolution
+
     def __draw_note_implement(self, note, order, pos):
         x_start = pos[0]
         x_end = x_start + self.key_size.get_widths()[order] - 1
-        y_start = pos[1] + int((1 - note.timing) * self.bar_height) - self.key_size.get_height() - 1
+        y_start = pos[1] + self.__offset(note.timing) - self.key_size.get_height() - 1
         y_end = y_start + self.key_size.get_height()
         self.drawer.rectangle((x_start, y_start, x_end, y_end), fill=self.color[order])
 
@@ -124,22 +405,22 @@ class NoteDrawer():
     def __draw_note_ln_layer_start(self, note, order, pos):
         x_start = pos[0] + 3
         x_end = x_start + self.key_size.get_widths()[order] - 1 - 6
-        y_start = pos[1] + int((1 - note.timing) * self.bar_height) - self.key_size.get_height() - 1
+        y_start = pos[1] + self.__offset(note.timing) - self.key_size.get_height() - 1
         y_end = y_start + self.key_size.get_height() - 2
         self.drawer.rectangle((x_start, y_start, x_end, y_end), fill=COLOR_YELLOW)
 
     def __draw_note_ln_layer_end(self, note, order, pos):
         x_start = pos[0] + 3
         x_end = x_start + self.key_size.get_widths()[order] - 1 - 6
-        y_start = pos[1] + int((1 - note.timing) * self.bar_height) - self.key_size.get_height() + 1
+        y_start = pos[1] + self.__offset(note.timing) - self.key_size.get_height() + 1
         y_end = y_start + self.key_size.get_height() - 2
         self.drawer.rectangle((x_start, y_start, x_end, y_end), fill=COLOR_YELLOW)
 
     def __draw_note_ln_layer(self, note, order, pos):
         x_start = pos[0] + 3
         x_end = x_start + self.key_size.get_widths()[order] - 1 - 6
-        y_start = pos[1] + int((1 - note.end) * self.bar_height) - 1
-        y_end = pos[1] + int((1 - note.start) * self.bar_height) - self.key_size.get_height() - 1
+        y_start = pos[1] + self.__offset(note.end) - 1
+        y_end = pos[1] + self.__offset(note.start) - self.key_size.get_height() - 1
         if note.is_start is True:
             y_end -= 1
         else:
@@ -159,9 +440,35 @@ class NoteDrawer():
             if isinstance(note, bms.LN):
                 self.__draw_note_ln_layer(note, order, pos)
 
+    def fill(self, canvas: ArrayCanvas, notes: NoteArray):
+        """
+        queue all notes to `canvas` in the same pixels as draw_note and draw_lnnote.
+        """
+        height = self.key_size.get_height()
+        x = notes.x
+        x_end = x + np.asarray(self.key_size.get_widths(), dtype=np.int64)[notes.order] - 1
+        color = np.asarray(self.color, dtype=np.uint8)[notes.order]
+        y = notes.y - height - 1
+
+        head = notes.kind != NoteArray.LN
+        canvas.rectangles(x[head], y[head], x_end[head], y[head] + height, color[head], notes.seq[head])
+
+        start = notes.kind == NoteArray.LN_START
+        canvas.rectangles(x[start] + 3, y[start], x_end[start] - 3, y[start] + height - 2, COLOR_YELLOW, notes.seq[start] + 1)
+        end = notes.kind == NoteArray.LN_END
+        canvas.rectangles(x[end] + 3, y[end] + 2, x_end[end] - 3, y[end] + height, COLOR_YELLOW, notes.seq[end] + 1)
+
+        ln = notes.kind == NoteArray.LN
+        y_start = notes.y[ln] - 1 - notes.is_end[ln]
+        y_end = np.where(notes.is_start[ln], notes.y_start[ln] - height - 2, notes.y_start[ln] - 1)
+        canvas.rectangles(x[ln] + 3, y_start, x_end[ln] - 3, y_end, COLOR_YELLOW, notes.seq[ln])
+
 class BMSImage():
     def __init__(self, data: Union[bms.BMS, List[bms.BarInfo]], style=None, keymode: KeyMode=KeyMode.mode7key, keysize: KeySize=ModeSevenKeySize(),
-        line_width: int=1, bar_height: int=200, canvas_height: int=1000, width_offset: int=20, height_offset: int=50):
+        line_width: int=1, bar_height: int=200, canvas_height: int=1000, width_offset: int=20, height_offset: int=50, density=None):
+        """
+        `density` is a DensityProfile of bmslevel, whose notes per second are drawn in the info column of bars.
+        """
         if isinstance(data, bms.BMS):
             self.data = data.bars
         elif isinstance(data, list) and len(data) > 0 and isinstance(data[0], bms.BarInfo):
@@ -178,6 +485,9 @@ class BMSImage():
         self.canvas_height = canvas_height
         self.width_offset = width_offset
         self.height_offset = height_offset
+        self._backgrounds = dict() # Dict[Tuple[int, ...], Image.Image], see _background
+        self.density = density
+        self._density_peak = None # notes per second of the densest window of the chart, kept in tiles
         if style is not None:
             self.style = style
         else:
@@ -210,84 +520,276 @@ class BMSImage():
         oneline_barlist.append(barlist)
         self.canvas = Canvas(cursor[0], self.canvas_height, oneline_barlist)
 
-    def _draw_bar_background(self):
-        dr = ImageDraw.Draw(self.image)
-        cursor = [ self.width_offset, self.canvas.height - self.height_offset - 1 ]
-        for line in self.canvas.barlist:
-            for b in line:
-                bar_width = self._bar_width()
-                bar_height = int(self.bar_height * b.beat)
-
-                # 黒の描画
-                # 左下から右上へ描画
-                dr.rectangle((cursor[0], cursor[1], cursor[0] + bar_width - 1, cursor[1] - bar_height + 1), fill=(0, 0, 0))
-
-                # 線の描画
-                # info line
-                line_cursor = [ cursor[0], cursor[1] - bar_height + 1 ]
-                dr.line((line_cursor[0], line_cursor[1], line_cursor[0], line_cursor[1] + bar_height - 1), \
-                    fill=(128, 128, 128), width=self.line_width)
-                line_cursor[0] += self.line_width
-                line_cursor[0] += self.info_width
-
-                # key line
-                for i in range(len(self.keysize.get_widths())):
-                    dr.line((line_cursor[0], line_cursor[1], line_cursor[0], line_cursor[1] + bar_height - 1), \
-                        fill=(128, 128, 128), width=self.line_width)
-                    line_cursor[0] += self.line_width
-                    line_cursor[0] += self.keysize.get_widths()[i]
-                dr.line((line_cursor[0], line_cursor[1], line_cursor[0], line_cursor[1] + bar_height- 1), \
-                    fill=(128, 128, 128), width=self.line_width)
-                dr.line((cursor[0], cursor[1], cursor[0] + bar_width - 1, cursor[1]), fill=(128, 128, 128), width=self.line_width)
-                cursor[1] -= bar_height
-            cursor[0] += self._bar_width()
-            cursor[0] += self.width_offset
-            cursor[1] = self.canvas.height - self.height_offset - 1
-
-    def _draw_notes(self, modify: List[int]=[0, 1, 2, 3, 4, 5, 6]):
-        dr = ImageDraw.Draw(self.image)
+    def _column_x(self, index: int) -> int:
+        return self.width_offset + index * (self._bar_width() + self.width_offset)
+
+    def _bar_positions(self, line: List[bms.BarInfo], x: int) -> List[Tuple[bms.BarInfo, int, int, int]]:
+        # (bar, height, top, left) of bars in a column
+        result = list()
+        cursor = self.canvas.height - self.height_offset - 1
+        for b in line:
+            bar_height = int(self.bar_height * b.beat)
+            result.append((b, bar_height, cursor - (bar_height - 1), x))
+            cursor -= bar_height
+        return result
+
+    def _lane_x(self, x: int) -> List[int]:
+        # left of lanes in a column
+        result = [ x + self.line_width * 2 + self.info_width ]
+        for width in self.keysize.get_widths()[:-1]:
+            result.append(result[-1] + width + self.line_width)
+        return result
+
+    def _draw_bar_background(self, dr: ImageDraw.ImageDraw, x: int, y: int, bar_height: int):
+        # (x, y) is the left bottom of the bar
+        bar_width = self._bar_width()
+
+        # 黒の描画
+        # 左下から右上へ描画
+        dr.rectangle((x, y - bar_height + 1, x + bar_width - 1, y), fill=(0, 0, 0))
+
+        # 線の描画
+        # info line
+        line_cursor = [ x, y - bar_height + 1 ]
+        dr.line((line_cursor[0], line_cursor[1], line_cursor[0], line_cursor[1] + bar_height - 1), \
+            fill=(128, 128, 128), width=self.line_width)
+        line_cursor[0] += self.line_width
+        line_cursor[0] += self.info_width
+
+        # key line
+        for i in range(len(self.keysize.get_widths())):
+            dr.line((line_cursor[0], line_cursor[1], line_cursor[0], line_cursor[1] + bar_height - 1), \
+                fill=(128, 128, 128), width=self.line_width)
+            line_cursor[0] += self.line_width
+            line_cursor[0] += self.keysize.get_widths()[i]
+        dr.line((line_cursor[0], line_cursor[1], line_cursor[0], line_cursor[1] + bar_height- 1), \
+            fill=(128, 128, 128), width=self.line_width)
+        dr.line((x, y, x + bar_width - 1, y), fill=(128, 128, 128), width=self.line_width)
+
+    def _background_margin(self) -> Tuple[int, int, int]:
+        # (left, right, bottom) of wide lines out of a bar
+        return ((self.line_width - 1) // 2, self.line_width // 2, self.line_width // 2)
+
+    def _background(self, heights: Tuple[int, ...]) -> Tuple[Image.Image, Optional[Image.Image]]:
+        """
+        image and mask of the backgrounds of bars of `heights` from the bottom, with the margins of wide lines.
+        the mask is None if the image has no transparent pixel, which is the case of line_width 1.
+        bars are drawn once for each height and columns of the same heights are reused.
+        """
+        if heights in self._backgrounds:
+            return self._backgrounds[heights]
+        left, right, bottom = self._background_margin()
+        image = Image.new("RGBA", (self._bar_width() + left + right, sum(heights) + bottom), (0, 0, 0, 0))
+        if len(heights) == 1:
+            self._draw_bar_background(ImageDraw.Draw(image), left, heights[0] - 1, heights[0])
+        else:
+            cursor = sum(heights)
+            for h in heights:
+                cursor -= h
+                bar, mask = self._background((h, ))
+                image.paste(bar, (0, cursor), mask)
+        mask = image.getchannel("A")
+        result = (image.convert("RGB"), mask if mask.getextrema()[0] < 255 else None)
+        self._backgrounds[heights] = result
+        return result
+
+    def _draw_line_background(self, image: Image.Image, line: List[bms.BarInfo], x: int):
+        heights = tuple([ int(self.bar_height * b.beat) for b in line ])
+        if len(heights) == 0:
+            return
+        background, mask = self._background(heights)
+        top = self.canvas.height - self.height_offset - sum(heights)
+        image.paste(background, (x - self._background_margin()[0], top), mask)
+
+    def _density_rectangles(self, positions: List[Tuple[bms.BarInfo, int, int, int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (left, y, right) of lines in the info column, whose length is notes per second of windows scaled by the peak.
+        """
+        x0, y, x1 = list(), list(), list()
+        peak = self._peak_density()
+        if peak > 0:
+            for bar, height, top, left in positions:
+                first, last = np.searchsorted(self.density.bar, [ bar.number, bar.number + 1 ])
+                length = np.round(self.density.nps[first:last] / peak * self.info_width).astype(np.int64)
+                row = top + height - 1 - (self.density.position[first:last] * height).astype(np.int64)
+                x0.append(np.full(last - first, left + self.line_width, dtype=np.int64)[length > 0])
+                y.append(row[length > 0])
+                x1.append(left + self.line_width + length[length > 0] - 1)
+        if len(x0) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        return (np.concatenate(x0), np.concatenate(y), np.concatenate(x1))
+
+    def _peak_density(self) -> float:
+        if self._density_peak is None:
+            self._density_peak = self.density.peak()[0]
+        return self._density_peak
+
+    def _draw_line_density(self, dr: ImageDraw.ImageDraw, line: List[bms.BarInfo], x: int):
+        for x0, y, x1 in zip(*[ a.tolist() for a in self._density_rectangles(self._bar_positions(line, x)) ]):
+            dr.rectangle((x0, y, x1, y), fill=COLOR_ORANGE)
+
+    def _fill_density(self, canvas: ArrayCanvas, positions: List[Tuple[bms.BarInfo, int, int, int]]):
+        x0, y, x1 = self._density_rectangles(positions)
+        canvas.rectangles(x0, y, x1, y, COLOR_ORANGE, np.arange(len(x0)))
+
+    def _set_drawer(self, dr: ImageDraw.ImageDraw):
         self.style.set_drawer(dr)
-        cursor = [ self.width_offset, self.canvas.height - self.height_offset - 1 ]
-        for line in self.canvas.barlist:
-            for b in line:
-                bar_height = int(self.bar_height * b.beat)
-                self.style.set_height(bar_height)
-                note_cursor = copy(cursor)
-                note_cursor[1] -= (bar_height - 1)
-
-                # draw bpm notes
-
-                for bpm in b.bpm:
-                    y_bpm = note_cursor[1] + int((1 - bpm.timing) * bar_height) - 1
-                    dr.line((note_cursor[0], y_bpm, note_cursor[0] + self._bar_width() - 2 * self.line_width - 1, y_bpm), \
-                        fill=(0, 255, 0), width=self.line_width*2)
-                    dr.text((note_cursor[0] + 2, y_bpm - 11), text=str(bpm.bpm), anchor='rs', fill=(0, 255, 0))
-
-                def move_cursor(cr, order):
-                    cr += self.keysize.get_widths()[order]
-                    cr += self.line_width
-                    return cr
-
-                note_cursor[0] += self.line_width * 2
-                note_cursor[0] += self.info_width
-                self.style.draw_note(b.notes[0], 0, note_cursor)
-                self.style.draw_lnnote(b.lnnotes[0], 0, note_cursor)
-
-                for i, m in enumerate(modify):
-                    note_cursor[0] = move_cursor(note_cursor[0], i)
-                    self.style.draw_note(b.notes[m + 1], i + 1, note_cursor)
-                    self.style.draw_lnnote(b.lnnotes[m + 1], i + 1, note_cursor)
-
-                cursor[1] -= bar_height
-            cursor[0] += self._bar_width()
-            cursor[0] += self.width_offset
-            cursor[1] = self.canvas.height - self.height_offset - 1
-
-    def draw(self, modify: List[int] = [0, 1, 2, 3, 4, 5, 6]):
+
+    def _draw_line_bpm(self, dr: ImageDraw.ImageDraw, b: bms.BarInfo, note_cursor: List[int], bar_height: int, text_only: bool=False):
+        for bpm in b.bpm:
+            y_bpm = note_cursor[1] + (b.resolution - bpm.timing) * bar_height // b.resolution - 1
+            if text_only is False:
+                dr.line((note_cursor[0], y_bpm, note_cursor[0] + self._bar_width() - 2 * self.line_width - 1, y_bpm), \
+                    fill=(0, 255, 0), width=self.line_width*2)
+            dr.text((note_cursor[0] + 2, y_bpm - 11), text=str(bpm.bpm), anchor='rs', fill=(0, 255, 0))
+
+    def _draw_line_bpm_text(self, dr: ImageDraw.ImageDraw, line: List[bms.BarInfo], x: int):
+        # the text of BPM is drawn on the left of the column, over the previous column
+        cursor = [ x, self.canvas.height - self.height_offset - 1 ]
+        for b in line:
+            bar_height = int(self.bar_height * b.beat)
+            self._draw_line_bpm(dr, b, [ cursor[0], cursor[1] - (bar_height - 1) ], bar_height, text_only=True)
+            cursor[1] -= bar_height
+
+    def _draw_line_notes(self, dr: ImageDraw.ImageDraw, line: List[bms.BarInfo], x: int, modify: List[int]):
+        cursor = [ x, self.canvas.height - self.height_offset - 1 ]
+        for b in line:
+            bar_height = int(self.bar_height * b.beat)
+            self.style.set_height(bar_height)
+            self.style.set_resolution(b.resolution)
+            note_cursor = copy(cursor)
+            note_cursor[1] -= (bar_height - 1)
+
+            # draw bpm notes
+
+            self._draw_line_bpm(dr, b, note_cursor, bar_height)
+
+            def move_cursor(cr, order):
+                cr += self.keysize.get_widths()[order]
+                cr += self.line_width
+                return cr
+
+            note_cursor[0] += self.line_width * 2
+            note_cursor[0] += self.info_width
+            self.style.draw_note(b.notes[0], 0, note_cursor)
+            self.style.draw_lnnote(b.lnnotes[0], 0, note_cursor)
+
+            for i, m in enumerate(modify):
+                note_cursor[0] = move_cursor(note_cursor[0], i)
+                self.style.draw_note(b.notes[m + 1], i + 1, note_cursor)
+                self.style.draw_lnnote(b.lnnotes[m + 1], i + 1, note_cursor)
+
+            cursor[1] -= bar_height
+
+    def _fill_background(self, canvas: ArrayCanvas, positions: List[Tuple[bms.BarInfo, int, int, int]]):
+        left = np.asarray([ p[3] for p in positions ], dtype=np.int64)
+        top = np.asarray([ p[2] for p in positions ], dtype=np.int64)
+        bottom = top + np.asarray([ p[1] for p in positions ], dtype=np.int64) - 1
+        seq = np.arange(len(positions), dtype=np.int64) * 2
+        bar_width = self._bar_width()
+        canvas.rectangles(left, top, left + bar_width - 1, bottom, (0, 0, 0), seq)
+
+        line_x = [ 0, self.line_width + self.info_width ]
+        for width in self.keysize.get_widths():
+            line_x.append(line_x[-1] + self.line_width + width)
+        line_x = left + np.asarray(line_x, dtype=np.int64)[:, None]
+        canvas.lines(line_x, top, line_x, bottom, (128, 128, 128), self.line_width, seq + 1)
+        canvas.lines(left, bottom, left + bar_width - 1, bottom, (128, 128, 128), self.line_width, seq + 1)
+
+    def _fill_notes(self, canvas: ArrayCanvas, positions: List[Tuple[bms.BarInfo, int, int, int]], modify: List[int]):
+        notes = NoteArray(positions, self._lane_x(0), [ 0 ] + [ m + 1 for m in modify ], bpm=True)
+        canvas.lines(notes.bpm_x, notes.bpm_y, notes.bpm_x + self._bar_width() - 2 * self.line_width - 1, notes.bpm_y,
+            (0, 255, 0), self.line_width * 2, notes.bpm_seq)
+        self.style.fill(canvas, notes)
+
+    def _tile_range(self, index: int) -> Tuple[int, int]:
+        # a tile is a column and the space on the left of it, the last one has the space on the right too
+        pitch = self._bar_width() + self.width_offset
+        if index + 1 < len(self.canvas.barlist):
+            return (index * pitch, (index + 1) * pitch)
+        return (index * pitch, self.canvas.width)
+
+    def _tile_source(self, first: int, last: int) -> 'BMSImage':
+        """
+        copy of self with only the bars needed to draw the tiles from `first` to `last - 1`, to be sent to a worker process.
+        """
+        source = copy(self)
+        source.data = None
+        source.image = None
+        source._backgrounds = dict()
+        source.style = copy(self.style)
+        source.style.set_drawer(None)
+        lines = self.canvas.barlist
+        # the BPM text of the next column is drawn on the last tile
+        source.canvas = Canvas(self.canvas.width, self.canvas.height,
+            [ x if first <= i <= last else list() for i, x in enumerate(lines) ])
+        if self.density is not None:
+            source._density_peak = self._peak_density()
+            numbers = [ b.number for x in lines[first:last] for b in x ]
+            if len(numbers) > 0:
+                source.density = self.density.between(min(numbers), max(numbers) + 1)
+        return source
+
+    def _draw_columns(self, first: int, last: int, modify: List[int], batch: bool) -> Image.Image:
+        """
+        image of the tiles from `first` to `last - 1`.
+        """
+        left = self._tile_range(first)[0]
+        right = self._tile_range(last - 1)[1]
+        lines = self.canvas.barlist
+        if batch is True:
+            canvas = ArrayCanvas(right - left, self.canvas.height, (200, 200, 200))
+            positions = list()
+            for i in range(first, last):
+                positions.extend(self._bar_positions(lines[i], self._column_x(i) - left))
+            self._fill_background(canvas, positions)
+            if self.density is not None:
+                canvas.next_layer()
+                self._fill_density(canvas, positions)
+            canvas.flush()
+            self._fill_notes(canvas, positions, modify)
+            for i in range(first, last):
+                self._draw_line_bpm_text(canvas, lines[i], self._column_x(i) - left)
+            dr = canvas
+        else:
+            image = Image.new("RGB", (right - left, self.canvas.height), (200, 200,200))
+            dr = ImageDraw.Draw(image)
+            for i in range(first, last):
+                self._draw_line_background(image, lines[i], self._column_x(i) - left)
+            if self.density is not None:
+                for i in range(first, last):
+                    self._draw_line_density(dr, lines[i], self._column_x(i) - left)
+            self._set_drawer(dr)
+            for i in range(first, last):
+                self._draw_line_notes(dr, lines[i], self._column_x(i) - left, modify)
+        if last < len(lines):
+            self._draw_line_bpm_text(dr, lines[last], self._column_x(last) - left)
+        return canvas.image() if batch is True else image
+
+    def draw(self, modify: List[int] = [0, 1, 2, 3, 4, 5, 6], workers: Optional[int]=1, batch: bool=False):
+        """
+        draw the image. with `batch`, the notes of each column are drawn at once by numpy, in the same pixels.
+        with `workers` other than 1, the columns are split into a range of tiles for each of `workers` processes
+        (None for the number of CPUs), drawn in a pool and pasted into the image.
+        """
         self._calc_info_of_canvas()
+        count = len(self.canvas.barlist)
+        if workers == 1:
+            self.image = self._draw_columns(0, count, modify, batch)
+            return
+
         self.image = Image.new("RGB", (self.canvas.width, self.canvas.height), (200, 200,200))
-        self._draw_bar_background()
-        self._draw_notes(modify)
+        size = math.ceil(count / (workers or os.cpu_count() or 1))
+        firsts = list(range(0, count, size))
+        lasts = [ min(x + size, count) for x in firsts ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tiles = executor.map(_draw_tile, [ self._tile_source(x, y) for x, y in zip(firsts, lasts) ], firsts, lasts,
+                [ modify ] * len(firsts), [ batch ] * len(firsts))
+            for first, tile in zip(firsts, tiles):
+                self.image.paste(tile, (self._tile_range(first)[0], 0))
+
+def _draw_tile(source: BMSImage, first: int, last: int, modify: List[int], batch: bool) -> Image.Image:
+    return source._draw_columns(first, last, modify, batch)
 
 class BMSDrawer():
     def __init__(self, bms: bms.BMS):
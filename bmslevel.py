@@ -1,10 +1,23 @@
+import os
+import sys
+import glob
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from abc import ABCMeta, abstractmethod
-from copy import deepcopy
+from copy import copy
 from math import sqrt
-from collections import Counter
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
 
 from common import *
 from bms import *
+from bmscache import BMSCache
+from oradb import SongDB
+from oraplayexceptions import OraPlayBaseException, ArgumentError, __LINE__
+from tempomap import TempoMap
 
 class CalcBase(metaclass=ABCMeta):
     @abstractmethod
@@ -18,97 +31,34 @@ class BpmDefinition:
         self.bpm = bpm
 
 class InputTimeline:
-
+    """
+    ms of key inputs of each lane, normal notes and LN starts, as sorted np.ndarray.
+    built in one pass over bars with the TempoMap of BMS.
+    """
     def __init__(self, bms: BMS):
         self.value = [BpmDefinition(0, 0, bms.bpm)] # BarNumber(int), Timing(Fraction), Bpm(float)
         self.beats = list()
-        self.key_ms = ( list(), list(), list(), list(), list(), list(), list(), list() )
+        numbers = ( list(), list(), list(), list(), list(), list(), list(), list() )
+        positions = ( list(), list(), list(), list(), list(), list(), list(), list() )
 
         for b in bms.bars:
-            if len(b.bpm) > 0:
-                for j in b.bpm:
-                    new_item = BpmDefinition(b.number, j.timing, j.bpm)
-                    self.value.append(new_item)
+            for j in b.bpm:
+                self.value.append(BpmDefinition(b.number, b.to_fraction(j.timing), j.bpm))
             self.beats.append(b.beat)
+            for i in range(8):
+                count = len(positions[i])
+                positions[i].extend([ n.timing / b.resolution for n in b.notes[i] ])
+                positions[i].extend([ n.timing / b.resolution for n in b.lnnotes[i] if isinstance(n, LNStart) is True ])
+                numbers[i].extend([ b.number ] * (len(positions[i]) - count))
 
-        current_ms = 0
-        current_bpm = bms.bpm
-        for b in bms.bars:
+        tempo = TempoMap.of(bms)
+        key_ms = list()
+        for i in range(8):
+            beats = tempo.position_to_beat_array(numbers[i], np.asarray(positions[i], dtype=np.float64))
+            key_ms.append(tempo.beat_to_ms_array(np.sort(beats, kind='stable')))
+        self.key_ms = tuple(key_ms) # Tuple[np.ndarray, ...]
 
-            def set_all_notes(notes, lnnotes, stops):
-                result = deepcopy(notes)
-                result.extend([x for x in lnnotes if isinstance(x, LNStart) is True])
-                if len(result) == 0:
-                    return None
-                result.sort(key=lambda x: x.timing)
-                if len(stops) == 0:
-                    return result
-
-                stop_process = deepcopy(result)
-                for stop in stops:
-                    for i, n in enumerate(result):
-                        if stop.timing < n.timing:
-                            stop_process[i].timing += Fraction(stop.duration, 192)
-
-                result = stop_process
-                return result
-
-            if len(b.bpm) == 0:
-                for i in range(8):
-                    notes = set_all_notes(b.notes[i], b.lnnotes[i], b.stops)
-                    if notes is None:
-                        continue
-
-                    for n in notes:
-                        ms = current_ms + ms_per_beat(current_bpm) * (b.beat * n.timing) * 4
-                        self.key_ms[i].append(ms)
-
-                stop_beats = 0
-                for stop in b.stops:
-                    stop_beats += Fraction(stop.duration, 192)
-                current_ms += ms_per_beat(current_bpm) * (b.beat + stop_beats) * 4
-
-                c = Counter(self.key_ms[i])
-                dup = [x for x in c.most_common() if x[1] > 1]
-                assert len(dup) == 0, 'duplicates note?, {}, {}, {}'.format(b.number, i, b.beat)
-                continue
-
-            def set_bpm_notes():
-                bpms = deepcopy(b.bpm)
-                last_bpm = BpmNote()
-                last_bpm.timing = 1
-                last_bpm.bpm = bpms[-1].bpm
-                bpms.append(last_bpm)
-                if len(b.stops) == 0:
-                    return bpms
-                stop_process = deepcopy(bpms)
-                for stop in b.stops:
-                    for i, bpm in enumerate(bpms):
-                        if stop.timing < bpm.timing:
-                            stop_process[i].timing += Fraction(stop.duration, 192)
-
-                bpms = stop_process
-                return bpms
-
-            current_beat = 0
-            bpms = set_bpm_notes()
-
-            for change_bpm in bpms:
-                for i in range(8):
-                    notes = set_all_notes(b.notes[i], b.lnnotes[i], b.stops)
-                    if notes is None:
-                        continue
-                    target_notes = [x for x in notes if current_beat <= x.timing and x.timing < change_bpm.timing]
-
-                    for n in target_notes:
-                        ms = current_ms + ms_per_beat(current_bpm) * b.beat * (n.timing - current_beat) * 4
-                        self.key_ms[i].append(ms)
-
-                current_ms += ms_per_beat(current_bpm) * b.beat * (change_bpm.timing - current_beat) * 4
-                current_beat = change_bpm.timing
-                current_bpm = change_bpm.bpm
-
-    def get_lane_timeline(self, index: int):
+    def get_lane_timeline(self, index: int) -> np.ndarray:
         return self.key_ms[index]
 
 
@@ -116,61 +66,242 @@ class CalcDensity(CalcBase):
     def __init__(self, bms: BMS):
         self.timeline = InputTimeline(bms)
 
+    @staticmethod
+    def influences(key_input_timings: np.ndarray, step: int) -> np.ndarray:
+        """
+        (200 / interval) ** 2 of each input from the input `step` before, 1 if there is no such input or it is at 0 ms.
+        """
+        result = np.ones(len(key_input_timings))
+        if len(key_input_timings) <= step:
+            return result
+        has_start = key_input_timings[:-step] != 0
+        inputs = key_input_timings[step:][has_start]
+        start = key_input_timings[:-step][has_start]
+        intervals = inputs - start
+        if np.any(intervals == 0):
+            i = np.flatnonzero(intervals == 0)[0]
+            assert False, 'input == start, ({}, {})'.format(float(inputs[i]), float(start[i]))
+        # float_power is the same as ** of float, which is not always x * x
+        result[step:][has_start] = np.float_power(float(200) / intervals, 2)
+        return result
+
     def calc(self):
+        # scratch is played up and down by turns, so an input is from the input 2 before
+        influences = [ CalcDensity.influences(self.timeline.get_lane_timeline(0), 2) ]
         total_notes = 0
-        key_input_intervals = ( list(), list(), list(), list(), list(), list(), list(), list() )
-
-        def process_for_scratch():
-            key_input_timings = self.timeline.get_lane_timeline(0)
-            start_up = 0
-            start_down = 0
-            for i, input in enumerate(key_input_timings):
-                if (i % 2) == 0:
-                    if start_up != 0:
-                        assert input != start_up, 'input == start_up, ({}, {})'.format(float(input), float(start_up))
-                        key_input_intervals[0].append(input - start_up)
-                    else:
-                        key_input_intervals[0].append(None)
-                    start_up = input
-                else:
-                    if start_down != 0:
-                        assert input != start_down, 'input == start_down, ({} {})'.format(float(input), float(start_down))
-                        key_input_intervals[0].append(input - start_down)
-                    else:
-                        key_input_intervals[0].append(None)
-                    start_down = input
-
-        def process():
-            nonlocal total_notes
-            for i in range(1, 8):
-                key_input_timings = self.timeline.get_lane_timeline(i)
-                total_notes += len(key_input_timings)
-                start = 0
-                for input in key_input_timings:
-                    if start != 0:
-                        assert input != start, 'input == start, ({}, {})'.format(float(input), float(start))
-                        key_input_intervals[i].append(input - start)
-                    else:
-                        key_input_intervals[i].append(None)
-                    start = input
-
-        process_for_scratch()
-        process()
-
-        key_influence = float(0)
-        for inputs in key_input_intervals:
-            for i in inputs:
-                if i is None:
-                    key_influence += 1
-                else:
-                    key_influence += (float(200) / i) ** 2
+        for i in range(1, 8):
+            key_input_timings = self.timeline.get_lane_timeline(i)
+            total_notes += len(key_input_timings)
+            influences.append(CalcDensity.influences(key_input_timings, 1))
+
+        # cumsum adds one by one in order, as the sum of float in a loop
+        influences = np.concatenate(influences)
+        key_influence = float(np.cumsum(influences)[-1]) if len(influences) > 0 else float(0)
         key_influence /= sqrt(total_notes)
         return key_influence
 
+class DensityProfile():
+    """
+    notes per second and key influence in windows of `window` ms, which start every `hop` ms from 0 ms to the last input.
+    influence of a window is the sum of (200 / interval) ** 2 of the inputs in it, same as CalcDensity.
+    each window is placed in the chart at its center, as bar number and position in the bar (0 <= position < 1).
+    """
+    def __init__(self, bms: BMS, window: float=1000, hop: float=100):
+        if window <= 0 or hop <= 0:
+            raise ArgumentError("window and hop must be positive", __LINE__())
+        self.window = window
+        self.hop = hop
+        timeline = InputTimeline(bms)
+
+        times = np.concatenate(timeline.key_ms)
+        influences = np.concatenate([ CalcDensity.influences(timeline.get_lane_timeline(0), 2) ] +
+            [ CalcDensity.influences(timeline.get_lane_timeline(i), 1) for i in range(1, 8) ])
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        total = np.concatenate(([ 0.0 ], np.cumsum(influences[order])))
+
+        count = int(times[-1] // hop) + 1 if len(times) > 0 else 0
+        self.start = np.arange(count) * float(hop) # ms of the start of windows
+        first = np.searchsorted(times, self.start, side='left')
+        last = np.searchsorted(times, self.start + window, side='left')
+        self.nps = (last - first) * 1000 / window
+        self.influence = total[last] - total[first]
+
+        tempo = TempoMap.of(bms)
+        self.bar, self.position = tempo.beat_to_position_array(tempo.ms_to_beat_array(self.start + window / 2))
+
+    def peak(self) -> Tuple[float, float]:
+        """
+        (notes per second, influence) of the densest windows.
+        """
+        if len(self.start) == 0:
+            return (float(0), float(0))
+        return (float(self.nps.max()), float(self.influence.max()))
+
+    def between(self, first: int, last: int) -> 'DensityProfile':
+        """
+        copy with only the windows placed in bars from `first` to `last - 1`. peak and percentile are of these windows.
+        """
+        result = copy(self)
+        begin, end = np.searchsorted(self.bar, [ first, last ])
+        for name in ('start', 'nps', 'influence', 'bar', 'position'):
+            setattr(result, name, getattr(self, name)[begin:end])
+        return result
+
+    def percentile(self, q: float) -> Tuple[float, float]:
+        """
+        q-th percentile (0 <= q <= 100) of (notes per second, influence) of windows.
+        """
+        if len(self.start) == 0:
+            return (float(0), float(0))
+        return (float(np.percentile(self.nps, q)), float(np.percentile(self.influence, q)))
+
 class BMSLevelCalculator():
-    def __init__(self, file: str):
-        self.bms = BMS(file)
+    def __init__(self, file: str, timing_type: TimingType=TimingType.Fraction, cache: BMSCache=None):
+        if cache is not None:
+            self.bms = cache.get(file, timing_type=timing_type)
+        else:
+            self.bms = BMS(file, timing_type)
         self.calc_density = CalcDensity(self.bms)
 
     def calc(self):
         return self.calc_density.calc()
+
+class LevelResult():
+    def __init__(self, chart: str, level: Optional[float]=None, error: Optional[str]=None, sha256: Optional[str]=None):
+        self.chart = chart
+        self.level = level
+        self.error = error
+        self.sha256 = sha256
+
+CHART_EXTENSIONS = ( ".bms", ".bme", ".bml" )
+
+def find_charts(paths: Iterable[str]) -> List[str]:
+    """
+    chart files in `paths`. directories are searched recursively for CHART_EXTENSIONS.
+    """
+    result = list()
+    for path in paths:
+        if os.path.isdir(path):
+            found = list()
+            for ext in CHART_EXTENSIONS:
+                found.extend(glob.glob(os.path.join(path, "**", "*" + ext), recursive=True))
+            result.extend(sorted(found))
+        else:
+            result.append(path)
+    return result
+
+def calc_level(chart: str, timing_type: TimingType=TimingType.Fraction, cache: BMSCache=None) -> LevelResult:
+    """
+    level of one chart. errors are returned in the result instead of raised,
+    so a broken chart does not stop the others.
+    """
+    try:
+        return LevelResult(chart, level=BMSLevelCalculator(chart, timing_type, cache).calc())
+    except (OraPlayBaseException, OSError) as e:
+        return LevelResult(chart, error=str(e))
+    except Exception as e:
+        return LevelResult(chart, error="{} : {}".format(type(e).__name__, e))
+
+def calc_levels(paths: Iterable[str], timing_type: TimingType=TimingType.Fraction, cache: BMSCache=None,
+    progress: Optional[Callable[[int, int, LevelResult], None]]=None) -> List[LevelResult]:
+    """
+    levels of charts in `paths`, files or directories of them.
+    `progress` is called with (done, total, result) for every chart.
+    """
+    charts = find_charts(paths)
+    results = list()
+    for chart in charts:
+        results.append(calc_level(chart, timing_type, cache))
+        if progress is not None:
+            progress(len(results), len(charts), results[-1])
+    return results
+
+def _calc_level_chunk(charts: List[Tuple[str, str]], timing_type: TimingType) -> List[LevelResult]:
+    result = list()
+    for sha256, path in charts:
+        r = calc_level(path, timing_type)
+        r.sha256 = sha256
+        result.append(r)
+    return result
+
+def calc_levels_of_db(db: str, output: str, workers: Optional[int]=None, chunk_size: int=32,
+    timing_type: TimingType=TimingType.Fraction,
+    progress: Optional[Callable[[int, int, LevelResult], None]]=None) -> List[LevelResult]:
+    """
+    levels of all charts in song table of songdata.db `db`, written into `level` table of SQLite `output`.
+    charts whose sha256 has a level in `output` already are skipped, and failed ones are tried again.
+    charts are sent to a pool of `workers` processes (None for the number of CPUs) in chunks of `chunk_size`,
+    and the results of each chunk are written in one transaction.
+    `progress` is called with (done, total, result) for every chart rated.
+    """
+    results = sqlite3.connect(output)
+    results.execute("CREATE TABLE IF NOT EXISTS level (sha256 TEXT PRIMARY KEY, path TEXT, level REAL, error TEXT)")
+    results.commit()
+    done = set([ x[0] for x in results.execute("SELECT sha256 FROM level WHERE level IS NOT NULL") ])
+
+    charts = dict() # Dict[str, str], sha256 -> path
+    for sha256, path in SongDB.of(db).get_songs():
+        if sha256 not in done and sha256 not in charts:
+            charts[sha256] = path
+    charts = list(charts.items())
+    chunks = [ charts[i:i + chunk_size] for i in range(0, len(charts), chunk_size) ]
+    rated = list() # List[LevelResult]
+
+    def write(chunk: List[LevelResult]):
+        with results:
+            results.executemany("INSERT OR REPLACE INTO level (sha256, path, level, error) VALUES (?, ?, ?, ?)",
+                [ (x.sha256, x.chart, x.level, x.error) for x in chunk ])
+        for r in chunk:
+            rated.append(r)
+            if progress is not None:
+                progress(len(rated), len(charts), r)
+
+    try:
+        if workers == 1:
+            for chunk in chunks:
+                write(_calc_level_chunk(chunk, timing_type))
+            return rated
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = { executor.submit(_calc_level_chunk, x, timing_type): x for x in chunks }
+            for future in as_completed(futures):
+                try:
+                    write(future.result())
+                except Exception as e:
+                    # worker died
+                    write([ LevelResult(path, error="{} : {}".format(type(e).__name__, e), sha256=sha256)
+                        for sha256, path in futures[future] ])
+        return rated
+    finally:
+        results.close()
+
+def main(argv: Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="calculate levels of BMS charts by density of key inputs")
+    parser.add_argument("charts", nargs="*", help="chart files or directories of them")
+    parser.add_argument("-d", "--db", default=None, help="songdata.db of beatoraja, to rate all charts in it")
+    parser.add_argument("-o", "--output", default="levels.db", help="SQLite file of levels of charts in --db")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes for --db")
+    args = parser.parse_args(argv)
+    if args.db is None and len(args.charts) == 0:
+        parser.error("charts or --db is required")
+
+    def progress(done: int, total: int, result: LevelResult):
+        if result.error is None:
+            print("[{}/{}] {:8.3f} {}".format(done, total, result.level, result.chart))
+        else:
+            print("[{}/{}] {} : {}".format(done, total, result.chart, result.error), file=sys.stderr)
+
+    start = time.perf_counter()
+    if args.db is not None:
+        results = calc_levels_of_db(args.db, args.output, args.jobs, progress=progress)
+    else:
+        results = calc_levels(args.charts, progress=progress)
+    elapsed = time.perf_counter() - start
+    failed = len([ x for x in results if x.error is not None ])
+    print("{} charts, {} failed, {:.1f} s ({:.1f} charts/sec)".format(
+        len(results), failed, elapsed, len(results) / elapsed if elapsed > 0 else 0))
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,11 @@
 from fractions import Fraction
+from functools import lru_cache
 
+@lru_cache(maxsize=None)
 def ms_per_beat(bpm: int):
-    return Fraction(60000 / bpm)
+    # exact for float bpm, without rounding 60000 / bpm
+    return Fraction(60000) / Fraction(bpm)
 
+@lru_cache(maxsize=None)
 def beat_per_ms(bpm: int):
-    return Fraction(bpm / 60000)
\ No newline at end of file
+    return Fraction(bpm) / Fraction(60000)
\ No newline at end of file
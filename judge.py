@@ -0,0 +1,151 @@
+from enum import IntEnum
+from typing import Dict
+
+import numpy as np
+
+from bms import BMS
+from notetable import NoteTable, NoteKind
+from replay import ReplayData, RandomType
+
+class JudgeType(IntEnum):
+    PGreat = 0
+    Great = 1
+    Good = 2
+    Bad = 3
+    Poor = 4
+
+class JudgeWindow():
+    """
+    judge windows in ms, same for early and late input.
+    """
+    def __init__(self, pgreat: float=20, great: float=60, good: float=150, bad: float=220):
+        self.pgreat = pgreat
+        self.great = great
+        self.good = good
+        self.bad = bad
+
+    def classify(self, offsets: np.ndarray) -> np.ndarray:
+        """
+        JudgeType of each offset. NaN (no input) and offsets out of the windows are Poor.
+        """
+        distance = np.abs(np.asarray(offsets, dtype=np.float64))
+        result = np.full(len(distance), JudgeType.Poor, dtype=np.int8)
+        for judge, window in ((JudgeType.Bad, self.bad), (JudgeType.Good, self.good),
+            (JudgeType.Great, self.great), (JudgeType.PGreat, self.pgreat)):
+            result[distance <= window] = judge
+        return result
+
+class JudgeResult():
+    def __init__(self):
+        self.notes = None # np.ndarray of NOTE_DTYPE, normal notes, LN starts and LN ends sorted by (ms, lane)
+        self.offset = None # np.ndarray, input ms - note ms, NaN for no input
+        self.judge = None # np.ndarray of JudgeType
+        self.empty_poor = int() # presses which hit no note
+        self.unknown_keys = int() # events of keys which are not in 7 keys and scratch, not judged
+
+    def counts(self) -> Dict[JudgeType, int]:
+        c = np.bincount(self.judge, minlength=len(JudgeType))
+        return { x: int(c[x]) for x in JudgeType }
+
+    def ex_score(self) -> int:
+        c = self.counts()
+        return c[JudgeType.PGreat] * 2 + c[JudgeType.Great]
+
+    def max_ex_score(self) -> int:
+        return len(self.notes) * 2
+
+class ReplayJudge():
+    """
+    judge key inputs of replay against notes of BMS.
+    a press is matched to the nearest unjudged note of the lane in the bad window,
+    and the release after a press on LN start is matched to the LN end.
+    each lane is judged by one sweep over sorted notes and inputs.
+    """
+    def __init__(self, bms: BMS, replay: ReplayData, window: JudgeWindow=JudgeWindow()):
+        self.table = NoteTable(bms)
+        self.replay = replay
+        self.window = window
+
+    def lane_of_key(self) -> np.ndarray:
+        """
+        lane of chart for each key index of ReplayData.get_key_arrays, -1 for unknown keys.
+        key index 0 and 9 are keycode 7 and 8, both directions of scratch.
+        """
+        if self.replay.option == RandomType.Mirror:
+            # get_pattern_modify does not mirror keys
+            modify = [ 6, 5, 4, 3, 2, 1, 0 ]
+        else:
+            modify = self.replay.get_pattern_modify()
+        return np.asarray([ 0 ] + [ x + 1 for x in modify ] + [ -1, 0 ])
+
+    def judge(self) -> JudgeResult:
+        data = self.table.data
+        notes = data[data['kind'] != NoteKind.LNBody]
+        offset = np.full(len(notes), np.nan)
+        empty_poor = 0
+
+        # key of replay -> lane of chart
+        time, key_index, pressed = self.replay.get_key_arrays()
+        lane_of_key = self.lane_of_key()
+        known = (key_index >= 0) & (key_index < len(lane_of_key))
+        lanes = np.full(len(key_index), -1)
+        lanes[known] = lane_of_key[key_index[known]]
+        order = np.argsort(time, kind='stable')
+
+        for lane in range(8):
+            note_index = np.flatnonzero(notes['lane'] == lane).tolist()
+            ms = notes['ms'][note_index].tolist()
+            kind = notes['kind'][note_index].tolist()
+
+            # notes judged by press, and LN end of each LN start
+            targets = [ i for i, k in enumerate(kind) if k != NoteKind.LNEnd ]
+            ln_end = dict() # Dict[int, int]
+            start = None
+            for i, k in enumerate(kind):
+                if k == NoteKind.LNStart:
+                    start = i
+                elif k == NoteKind.LNEnd and start is not None:
+                    ln_end[start] = i
+                    start = None
+
+            judged = [ False ] * len(targets)
+            cursor = 0
+            holding = None
+            lane_order = order[lanes[order] == lane]
+            for t, is_press in zip(time[lane_order].tolist(), pressed[lane_order].tolist()):
+                if is_press is False:
+                    if holding is not None:
+                        offset[note_index[holding]] = t - ms[holding]
+                        holding = None
+                    continue
+
+                # notes which can not be hit any more are left as Poor
+                while cursor < len(targets) and (judged[cursor] or ms[targets[cursor]] + self.window.bad < t):
+                    cursor += 1
+                if cursor == len(targets):
+                    empty_poor += 1
+                    continue
+
+                nearest = cursor
+                for j in range(cursor + 1, len(targets)):
+                    if judged[j]:
+                        continue
+                    if abs(ms[targets[j]] - t) >= abs(ms[targets[nearest]] - t):
+                        break
+                    nearest = j
+                target = targets[nearest]
+                if abs(ms[target] - t) > self.window.bad:
+                    empty_poor += 1
+                    continue
+
+                judged[nearest] = True
+                offset[note_index[target]] = t - ms[target]
+                holding = ln_end.get(target)
+
+        result = JudgeResult()
+        result.notes = notes
+        result.offset = offset
+        result.judge = self.window.classify(offset)
+        result.empty_poor = empty_poor
+        result.unknown_keys = int(np.count_nonzero(lanes < 0))
+        return result
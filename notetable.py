@@ -0,0 +1,90 @@
+from enum import IntEnum
+
+import numpy as np
+
+from bms import BMS, LNStart, LN
+from tempomap import TempoMap
+
+class NoteKind(IntEnum):
+    Normal = 0
+    LNStart = 1
+    LNBody = 2
+    LNEnd = 3
+
+NOTE_DTYPE = np.dtype([
+    ('bar', np.int32),        # bar number
+    ('lane', np.int8),        # 0: scratch, 1-7: keys
+    ('kind', np.int8),        # NoteKind
+    ('wav', np.int16),        # defwav, 0 for LN body
+    ('position', np.float64), # position in the bar, [0, 1]
+    ('end', np.float64),      # end position in the bar of LN body, same as position for others
+    ('beat', np.float64),     # beats from the start of the chart
+    ('ms', np.float64),       # ms from the start of the chart
+])
+
+class NoteTable():
+    """
+    columnar store of all notes in BMS, sorted by (ms, lane).
+    """
+    def __init__(self, bms: BMS):
+        bars = list()
+        lanes = list()
+        kinds = list()
+        wavs = list()
+        positions = list()
+        ends = list()
+
+        for bar in bms.bars:
+            resolution = bar.resolution
+            for lane in range(8):
+                for n in bar.notes[lane]:
+                    bars.append(bar.number)
+                    lanes.append(lane)
+                    kinds.append(NoteKind.Normal)
+                    wavs.append(n.defwav)
+                    positions.append(n.timing / resolution)
+                    ends.append(n.timing / resolution)
+                for n in bar.lnnotes[lane]:
+                    bars.append(bar.number)
+                    lanes.append(lane)
+                    if isinstance(n, LN):
+                        kinds.append(NoteKind.LNBody)
+                        wavs.append(0)
+                        positions.append(n.start / resolution)
+                        ends.append(n.end / resolution)
+                        continue
+                    kinds.append(NoteKind.LNStart if isinstance(n, LNStart) else NoteKind.LNEnd)
+                    wavs.append(n.defwav)
+                    positions.append(n.timing / resolution)
+                    ends.append(n.timing / resolution)
+
+        data = np.zeros(len(bars), dtype=NOTE_DTYPE)
+        data['bar'] = bars
+        data['lane'] = lanes
+        data['kind'] = kinds
+        data['wav'] = wavs
+        data['position'] = positions
+        data['end'] = ends
+
+        tempo = TempoMap.of(bms)
+        data['beat'] = tempo.position_to_beat_array(data['bar'], data['position'])
+        data['ms'] = tempo.beat_to_ms_array(data['beat'])
+        self.data = data[np.lexsort((data['lane'], data['ms']))]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def lane(self, index: int) -> np.ndarray:
+        return self.data[self.data['lane'] == index]
+
+    def kind(self, kind: NoteKind) -> np.ndarray:
+        return self.data[self.data['kind'] == kind]
+
+    def playable(self) -> np.ndarray:
+        """
+        notes which need a key press, normal notes and LN starts.
+        """
+        return self.data[(self.data['kind'] == NoteKind.Normal) | (self.data['kind'] == NoteKind.LNStart)]
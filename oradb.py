@@ -1,28 +1,84 @@
+import os
 import sqlite3
+import threading
 from enum import Enum, auto
+from typing import Dict, Iterable, List, Tuple
+from urllib.request import pathname2url
 
 from bms import BMS
-from oraplayexceptions import ArgumentError, __LINE__
+from oraplayexceptions import ArgumentError, NotFoundChart, __LINE__
 
 class HashType(Enum):
     md5 = auto()
     sha256 = auto()
 
 class SongDB():
-    def __init__(self, path: str):
-        self.db = sqlite3.connect(path)
+    """
+    songdata.db of beatoraja, opened read only.
+    with `immutable`, SQLite does not lock nor check changes of the file, so it must not be written while opened.
+    the connection can be used from any thread. use SongDB.of(path) to share one instance in a process.
+    """
+    # max number of hashes in a query of get_file_paths
+    HASHES_PER_QUERY = 500
 
-    def get_file_path(self, hash: str, hash_type: HashType=HashType.sha256):
+    __shared = dict() # Dict[Tuple[str, bool, int], SongDB], (path, immutable, pid)
+    __lock = threading.Lock()
+
+    def __init__(self, path: str, immutable: bool=False):
+        uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(path)))
+        if immutable is True:
+            uri += "&immutable=1"
+        self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    @classmethod
+    def of(cls, path: str, immutable: bool=False) -> 'SongDB':
+        """
+        SongDB of `path` shared in this process.
+        """
+        key = (os.path.abspath(path), immutable, os.getpid())
+        with cls.__lock:
+            song_db = cls.__shared.get(key)
+            if song_db is None:
+                song_db = cls(path, immutable)
+                cls.__shared[key] = song_db
+            return song_db
+
+    @staticmethod
+    def __column(hash_type: HashType) -> str:
         if hash_type == HashType.sha256:
-            hash_str = "sha256"
+            return "sha256"
         elif hash_type == HashType.md5:
-            hash_str = "md5"
-        else:
-            raise ArgumentError("hash type is invalid", __LINE__())
-        c = self.db.execute("SELECT path FROM song WHERE {}='{}'".format(hash_str, hash))
+            return "md5"
+        raise ArgumentError("hash type is invalid", __LINE__())
+
+    def get_file_path(self, hash: str, hash_type: HashType=HashType.sha256):
+        hash_str = SongDB.__column(hash_type)
+        c = self.db.execute("SELECT path FROM song WHERE {}=?".format(hash_str), (hash, ))
         data = c.fetchone()
+        if data is None:
+            raise NotFoundChart("{} {} is not in song table".format(hash_str, hash), __LINE__())
         return data[0]
 
+    def get_file_paths(self, hashes: Iterable[str], hash_type: HashType=HashType.sha256) -> Dict[str, str]:
+        """
+        paths of many charts at once. hashes which are not in song table are not in the result.
+        """
+        hash_str = SongDB.__column(hash_type)
+        hashes = list(set(hashes))
+        result = dict()
+        for i in range(0, len(hashes), SongDB.HASHES_PER_QUERY):
+            chunk = hashes[i:i + SongDB.HASHES_PER_QUERY]
+            c = self.db.execute("SELECT {0}, path FROM song WHERE {0} IN ({1})".format(hash_str, ", ".join([ "?" ] * len(chunk))), chunk)
+            for hash, path in c.fetchall():
+                result.setdefault(hash, path)
+        return result
+
+    def get_songs(self) -> List[Tuple[str, str]]:
+        """
+        (sha256, path) of every chart in song table.
+        """
+        return self.db.execute("SELECT sha256, path FROM song").fetchall()
+
     def get_bms_from_hash(self, hash: str, hash_type: HashType=HashType.sha256):
         file_path = self.get_file_path(hash, hash_type)
         return BMS(file_path)
@@ -42,3 +42,17 @@ class FailedParseReplay(OraPlayBaseException):
 
     def __str__(self):
         return super(OraPlayBaseException, self).__str__()
+
+class OutOfTimeline(OraPlayBaseException):
+    def __init__(self, message: str, line: int=0):
+        super(OraPlayBaseException, self).__init__(type(self).__name__, message, line)
+
+    def __str__(self):
+        return super(OraPlayBaseException, self).__str__()
+
+class NotFoundChart(OraPlayBaseException):
+    def __init__(self, message: str, line: int=0):
+        super(OraPlayBaseException, self).__init__(type(self).__name__, message, line)
+
+    def __str__(self):
+        return super(OraPlayBaseException, self).__str__()
@@ -0,0 +1,170 @@
+import os
+import sys
+import glob
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from oraplayexceptions import OraPlayBaseException, NotFoundChart, __LINE__
+from oradb import SongDB
+from bms import BMS, TimingType
+from replay import ReplayData, BeatConvertedReplay, ReplayImage
+
+class RenderResult():
+    def __init__(self, replay: str, output: Optional[str]=None, error: Optional[str]=None):
+        self.replay = replay
+        self.output = output
+        self.error = error
+
+def find_replays(paths: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    (replay file, name of output) of replays in `paths`. directories are searched recursively for *.gz.
+    the name is the path relative to the directory, or the file name for a file, without .gz.
+    """
+    result = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for replay in sorted(glob.glob(os.path.join(path, "**", "*.gz"), recursive=True)):
+                result.append((replay, os.path.relpath(replay, path)[:-3]))
+        else:
+            name = os.path.basename(path)
+            result.append((path, name[:-3] if name.endswith(".gz") else name))
+    return result
+
+def output_path(name: str, output_dir: str) -> str:
+    return os.path.join(output_dir, name + ".png")
+
+def error_message(e: Exception) -> str:
+    if isinstance(e, (OraPlayBaseException, OSError)):
+        return str(e)
+    return "{} : {}".format(type(e).__name__, e)
+
+def draw_replay(bms: BMS, replay_data: ReplayData, output: str,
+    threshold: int=100, threshold_scratch: int=400) -> str:
+    """
+    draw a replay of `bms` into PNG of `output`, and return the path of it.
+    """
+    convert = BeatConvertedReplay()
+    convert.convert_batch(bms, replay_data, threshold, threshold_scratch)
+    image = ReplayImage(bms, convert.bars)
+    image.draw(modify=replay_data.get_pattern_modify())
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    image.image.save(output)
+    return output
+
+def render_chart(chart: str, replays: List[Tuple[str, str]],
+    threshold: int=100, threshold_scratch: int=400, timing_type: TimingType=TimingType.Fraction) -> List[RenderResult]:
+    """
+    render (replay file, output) of one chart file. the chart is parsed once for all of them.
+    replays are loaded here, so they are not sent to a worker process.
+    errors are returned in the results instead of raised, because exceptions of oraplay can not be pickled.
+    """
+    try:
+        bms = BMS(chart, timing_type)
+    except Exception as e:
+        return [ RenderResult(path, error=error_message(e)) for path, output in replays ]
+
+    result = list()
+    for path, output in replays:
+        try:
+            replay_data = ReplayData(path, stream=True)
+            result.append(RenderResult(path, output=draw_replay(bms, replay_data, output, threshold, threshold_scratch)))
+        except Exception as e:
+            result.append(RenderResult(path, error=error_message(e)))
+    return result
+
+def render_many(replays: Iterable[str], db: str, output_dir: str, workers: Optional[int]=None,
+    threshold: int=100, threshold_scratch: int=400, timing_type: TimingType=TimingType.Fraction,
+    progress: Optional[Callable[[int, int, RenderResult], None]]=None) -> List[RenderResult]:
+    """
+    render replays into PNG files in `output_dir`, keeping the paths of replays relative to the given directories.
+    replays are grouped by sha256 of the chart read from their headers, and paths of the charts are looked up at once.
+    each group is a task of render_chart in a pool of `workers` processes, so the chart is parsed once per task.
+    a chart with more replays than total / workers is split into tasks of that size to keep all workers busy.
+    `progress` is called with (done, total, result) for every replay.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = find_replays(replays)
+    results = list() # List[RenderResult]
+    total = len(paths)
+
+    def report(result: RenderResult):
+        results.append(result)
+        if progress is not None:
+            progress(len(results), total, result)
+
+    charts = dict() # Dict[str, List[Tuple[str, str]]], sha256 -> (replay file, output)
+    outputs = dict() # Dict[str, str], output -> replay file
+    for path, name in paths:
+        output = output_path(name, output_dir)
+        if output in outputs:
+            report(RenderResult(path, error="{} is also the output of {}".format(output, outputs[output])))
+            continue
+        outputs[output] = path
+        try:
+            sha256 = ReplayData.read_header(path)["sha256"]
+        except Exception as e:
+            report(RenderResult(path, error=error_message(e)))
+            continue
+        charts.setdefault(sha256, list()).append((path, output))
+
+    db_error = None
+    try:
+        chart_paths = SongDB.of(db).get_file_paths(charts.keys())
+    except Exception as e:
+        chart_paths = dict()
+        db_error = error_message(e)
+    for sha256 in [ x for x in charts.keys() if x not in chart_paths ]:
+        error = db_error or error_message(NotFoundChart("sha256 {} is not in song table".format(sha256), __LINE__()))
+        for path, output in charts.pop(sha256):
+            report(RenderResult(path, error=error))
+
+    size = max(1, math.ceil(total / (workers or os.cpu_count() or 1)))
+    tasks = [ (chart_paths[sha256], x[i:i + size]) for sha256, x in charts.items() for i in range(0, len(x), size) ]
+
+    if workers == 1:
+        for chart, task in tasks:
+            for result in render_chart(chart, task, threshold, threshold_scratch, timing_type):
+                report(result)
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for chart, task in tasks:
+            future = executor.submit(render_chart, chart, task, threshold, threshold_scratch, timing_type)
+            futures[future] = task
+        for future in as_completed(futures):
+            try:
+                for result in future.result():
+                    report(result)
+            except Exception as e:
+                # worker died
+                for path, output in futures[future]:
+                    report(RenderResult(path, error=error_message(e)))
+    return results
+
+def main(argv: Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="render replay images of beatoraja")
+    parser.add_argument("replays", nargs="+", help="replay files (.gz) or directories of them")
+    parser.add_argument("-d", "--db", required=True, help="songdata.db of beatoraja")
+    parser.add_argument("-o", "--output", default=".", help="output directory of PNG files")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--threshold", type=int, default=100, help="max ms of a tap")
+    parser.add_argument("--threshold-scratch", type=int, default=400, help="max ms of a tap of scratch")
+    args = parser.parse_args(argv)
+
+    def progress(done: int, total: int, result: RenderResult):
+        if result.error is None:
+            print("[{}/{}] {} -> {}".format(done, total, result.replay, result.output))
+        else:
+            print("[{}/{}] {} : {}".format(done, total, result.replay, result.error), file=sys.stderr)
+
+    results = render_many(args.replays, args.db, args.output, args.jobs,
+        args.threshold, args.threshold_scratch, progress=progress)
+    failed = len([ x for x in results if x.error is not None ])
+    print("{} rendered, {} failed".format(len(results) - failed, failed))
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
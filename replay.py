@@ -1,12 +1,16 @@
 import gzip
 import json
-from typing import Dict, List, Tuple
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
 from enum import Enum, auto
-from fractions import Fraction
 
-from oraplayexceptions import OraPlayBaseException, FailedParseReplay, __LINE__
-from oradb import SongDB
-from bms import BMS, BarInfo, Note, BpmNote, LNStart, LN, LNEnd
+import numpy as np
+
+from oraplayexceptions import OraPlayBaseException, FailedParseReplay, OutOfTimeline, __LINE__
+from oradb import SongDB, HashType
+from bmscache import BMSCache
+from tempomap import TempoMap
+from bms import BMS, BarInfo, Note, LNStart, LN, LNEnd, TimingType
 from common import *
 from bmsdrawer import *
 
@@ -18,10 +22,144 @@ class RandomType(Enum):
     Random = auto()
     Others = auto()
 
+class ReplayStreamReader():
+    """
+    incremental reader of gzipped replay.
+    fields except keylog are decoded into `header`,
+    and keylog is packed into arrays of time, keycode and pressed without making dict of each event.
+    without `keylog`, keylog is skipped and the arrays are empty.
+    """
+    def __init__(self, path: str, chunk_size: int=1 << 16, keylog: bool=True):
+        self.header = dict()
+        self.time = array('q')
+        self.keycode = array('b')
+        self.pressed = array('b')
+
+        self.__decoder = json.JSONDecoder()
+        self.__buffer = ''
+        self.__pos = 0
+        self.__eof = False
+        self.__chunk_size = chunk_size
+        self.__keylog = keylog
+        with gzip.open(path, mode='rt', encoding='utf-8') as f:
+            self.__file = f
+            self.__parse()
+            self.__file = None
+        # decoder can not be pickled
+        self.__decoder = None
+        self.__buffer = ''
+
+    def __fill(self) -> bool:
+        if self.__eof:
+            return False
+        chunk = self.__file.read(self.__chunk_size)
+        if len(chunk) == 0:
+            self.__eof = True
+            return False
+        # drop consumed text to keep the buffer small
+        self.__buffer = self.__buffer[self.__pos:] + chunk
+        self.__pos = 0
+        return True
+
+    def __peek(self) -> str:
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos] in ' \t\r\n':
+                self.__pos += 1
+            if self.__pos < len(self.__buffer):
+                return self.__buffer[self.__pos]
+            if self.__fill() is False:
+                raise FailedParseReplay("unexpected end of replay", __LINE__())
+
+    def __expect(self, chars: str) -> str:
+        c = self.__peek()
+        if c not in chars:
+            raise FailedParseReplay("'{}' is expected but '{}' is found".format(chars, c), __LINE__())
+        self.__pos += 1
+        return c
+
+    def __value(self):
+        self.__peek()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buffer, self.__pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.__buffer) or self.__eof:
+                    self.__pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.__eof:
+                    raise FailedParseReplay("invalid value in replay", __LINE__())
+            self.__fill()
+
+    def __parse_keylog(self) -> None:
+        self.__expect('[')
+        if self.__peek() == ']':
+            self.__pos += 1
+            return
+        while True:
+            c = self.__peek()
+            if c != '{':
+                raise FailedParseReplay("'{{' is expected but '{}' is found".format(c), __LINE__())
+
+            # events are flat objects, so complete events in the buffer are decoded at once
+            close = self.__buffer.find(']', self.__pos)
+            end = self.__buffer.rfind('}', self.__pos, close if close >= 0 else len(self.__buffer))
+            if end < 0:
+                if self.__fill() is False:
+                    raise FailedParseReplay("unexpected end of replay", __LINE__())
+                continue
+            try:
+                keys = json.loads('[' + self.__buffer[self.__pos:end + 1] + ']')
+            except json.JSONDecodeError:
+                raise FailedParseReplay("invalid keylog in replay", __LINE__())
+            self.__pos = end + 1
+            self.time.extend([ x.get("time", 0) for x in keys ])
+            self.keycode.extend([ x.get("keycode", 0) for x in keys ])
+            self.pressed.extend([ x.get("pressed", False) is True for x in keys ])
+            if self.__expect(',]') == ']':
+                return
+
+    def __skip_keylog(self) -> None:
+        self.__expect('[')
+        # events are flat objects, so keylog ends at the first ']'
+        while True:
+            close = self.__buffer.find(']', self.__pos)
+            if close >= 0:
+                self.__pos = close + 1
+                return
+            self.__pos = len(self.__buffer)
+            if self.__fill() is False:
+                raise FailedParseReplay("unexpected end of replay", __LINE__())
+
+    def __parse(self) -> None:
+        self.__expect('{')
+        if self.__peek() == '}':
+            return
+        while True:
+            name = self.__value()
+            self.__expect(':')
+            if name == "keylog":
+                if self.__keylog is True:
+                    self.__parse_keylog()
+                else:
+                    self.__skip_keylog()
+            else:
+                self.header[name] = self.__value()
+            if self.__expect(',}') == '}':
+                return
+
 class ReplayData():
-    def __init__(self, path: str):
-        with gzip.open(path) as f:
-            self.data = json.load(f)
+    def __init__(self, path: str, stream: bool=False):
+        """
+        keylog of streamed replay is kept as arrays, not in `data`.
+        """
+        self.stream = None
+        if stream:
+            self.stream = ReplayStreamReader(path)
+            self.data = self.stream.header
+        else:
+            with gzip.open(path) as f:
+                self.data = json.load(f)
         if self.data["randomoption"] == 0:
             self.option = RandomType.Normal
         elif self.data["randomoption"] == 1:
@@ -32,6 +170,13 @@ class ReplayData():
             # 現在未対応
             self.option = RandomType.Others
 
+    @staticmethod
+    def read_header(path: str) -> Dict:
+        """
+        fields of replay except keylog, which is skipped without decoding events.
+        """
+        return ReplayStreamReader(path, keylog=False).header
+
     def __enter__(self):
         return self
 
@@ -42,8 +187,37 @@ class ReplayData():
         return self.data["sha256"]
 
     def get_keys(self) -> List:
+        if self.stream is not None:
+            return list(self.iter_keys())
         return self.data["keylog"]
 
+    def iter_keys(self) -> Iterator[Dict]:
+        if self.stream is None:
+            yield from self.data["keylog"]
+            return
+        for time, keycode, pressed in zip(self.stream.time, self.stream.keycode, self.stream.pressed):
+            yield { "keycode": keycode, "time": time, "pressed": pressed == 1 }
+
+    def get_key_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        return keylog as arrays of (time, key index, pressed).
+        key index is 0 for scratch and 1-7 for keys, and 9 for keycode 8, the other direction of scratch.
+        """
+        if self.stream is not None:
+            time = np.frombuffer(self.stream.time, dtype=np.int64)
+            keycode = np.frombuffer(self.stream.keycode, dtype=np.int8).astype(np.int64)
+            pressed = np.frombuffer(self.stream.pressed, dtype=np.int8) == 1
+            key_index = np.where(keycode == 7, 0, keycode + 1)
+            return (time, key_index, pressed)
+
+        keys = self.get_keys()
+        # time and keycode are omitted for 0, and pressed is omitted for release
+        time = np.fromiter((x.get("time", 0) for x in keys), dtype=np.int64, count=len(keys))
+        keycode = np.fromiter((x.get("keycode", 0) for x in keys), dtype=np.int64, count=len(keys))
+        pressed = np.fromiter((x.get("pressed", False) is True for x in keys), dtype=bool, count=len(keys))
+        key_index = np.where(keycode == 7, 0, keycode + 1)
+        return (time, key_index, pressed)
+
     def get_pattern_modify(self) -> List[int]:
         if self.option == RandomType.Normal:
             return [0, 1, 2, 3, 4, 5, 6]
@@ -54,64 +228,24 @@ class ReplayData():
         if self.option == RandomType.Others:
             raise OraPlayBaseException("this option is not supported", __LINE__())
 
-class TimeDefinition():
-    def __init__(self):
-        self.start_bar = int()
-        self.start_beat = Fraction(0, 1)
-        self.bpm = float()
-        self.start_ms = int()
-        self.end_ms = int()
-
 class BeatConvertedReplay():
     def __init__(self):
-        self.time_definition = list() # List[TimeDefinition]
+        self.time_definition = list() # List[TempoSegment]
         self.bars = list() # List[BarInfo]
         self.modify = list() # List[int]
-
-    def __calculate_timing(self, bms: BMS) -> List[TimeDefinition]:
-        result = list()
-        current_ms = 0
-        current_beat = 0
-        current_bpm = bms.bpm
-        current_start_bar = 0
-        current_start_beat = Fraction(0, 1)
-
-        def make_new_time_definition():
-            new_def = TimeDefinition()
-            new_def.start_beat = current_start_beat
-            new_def.start_ms = current_ms
-            new_def.end_ms = current_ms + (current_beat * 4 * ms_per_beat(current_bpm)) - 1
-            new_def.start_bar = current_start_bar
-            new_def.bpm = current_bpm
-            return new_def
-
-        def reset_current_state(b: BpmNote):
-            nonlocal current_ms
-            nonlocal current_beat
-            nonlocal current_bpm
-            nonlocal current_start_bar
-            nonlocal current_start_beat
-
-            current_ms = result[-1].end_ms + 1
-            current_beat = 0
-            current_bpm = b.bpm
-            current_start_bar = bar.number
-            current_start_beat = b.timing
-
-        for bar in bms.bars:
-            if len(bar.bpm) == 0:
-                current_beat += bar.beat
-                continue
-            before_timing = Fraction()
-            for b in bar.bpm:
-                current_beat += (b.timing - before_timing)
-                before_timing = b.timing
-
-                result.append(make_new_time_definition())
-                reset_current_state(b)
-
-        result.append(make_new_time_definition())
-        return result
+        self.unknown_keys = int() # events of keys which are not in 7 keys and scratch, not converted
+
+    @staticmethod
+    def lane_of_key(key_index: int) -> Optional[int]:
+        """
+        lane of bars for key index of ReplayData.get_key_arrays, None for unknown keys.
+        both directions of scratch are lane 0.
+        """
+        if key_index == 9:
+            return 0
+        if 0 <= key_index <= 7:
+            return key_index
+        return None
 
     def convert(self, bms: BMS, replay: ReplayData, threshold: int = 100, threshold_scratch: int = 400):
 
@@ -121,113 +255,80 @@ class BeatConvertedReplay():
                 self.bar = int()
                 self.pressed = False
 
-        class NoMoreBar(Exception):
-            def __init__(self):
-                pass
-
-        result = list() # List[BarInfo]
-        timings = self.__calculate_timing(bms)
-        status = ( KeyStatus(), KeyStatus(), KeyStatus(), KeyStatus(), KeyStatus(), KeyStatus(), KeyStatus(), KeyStatus() )
+        result = dict() # Dict[int, BarInfo]
+        tempo = TempoMap.of(bms)
+        self.time_definition = tempo.segments
+        # by key index, each direction of scratch is pressed and released separately
+        status = [ KeyStatus() for _ in range(10) ]
+        self.unknown_keys = 0
 
         def calc_timing(ms: int) -> Tuple[int, int]:
-
-            def get_timing_index(ms: int) -> int:
-                for i, t in enumerate(timings):
-                    if t.start_ms <= ms and ms <= t.end_ms:
-                        return i
-                raise NoMoreBar()
-
-            timing = timings[get_timing_index(ms)]
-            beat = Fraction((ms - timing.start_ms) * beat_per_ms(timing.bpm) / 4)
-            result_bar_number = timing.start_bar
-            result_timing = timing.start_beat + beat
-
-            counter = 0
-            while True:
-                try:
-                    beat_temp = bms.bars[result_bar_number].beat
-                except IndexError:
-                    beat_temp = 1
-                if result_timing >= beat_temp:
-                    result_timing -= beat_temp
-                    result_bar_number += 1
-                    counter += 1
-                    continue
-                break
-
-            return (result_bar_number, result_timing)
+            return tempo.ms_to_timing(ms)
 
         def get_key_index(key):
             # scratch
-            try:
-                if key["keycode"] == 7:
-                    return 0
-                return key["keycode"] + 1
-            except KeyError:
-                return 1
+            keycode = key.get("keycode", 0)
+            if keycode == 7:
+                return 0
+            return keycode + 1
 
         def is_scratch(value: int) -> bool:
-            return value == 8
+            return value == 0
 
-        def get_barinfo(bars: List[BarInfo], number: int) -> BarInfo:
+        def get_barinfo(bars: Dict[int, BarInfo], number: int) -> BarInfo:
             try:
-                i = next(filter(lambda x: x.number == number, bars))
-                return i
-            except StopIteration:
+                return bars[number]
+            except KeyError:
                 # no element
                 pass
-            bar = BarInfo()
+            bar = BarInfo().allocate()
             bar.number = number
             return bar
 
-        def set_barinfo(bars: List[BarInfo], new_item: BarInfo) -> None:
-            try:
-                i = next(filter(lambda x: x[1].number == new_item.number, enumerate(bars)))
-                bars[i[0]] = new_item
-                return
-            except StopIteration:
-                #no element
-                pass
-            bars.append(new_item)
+        def set_barinfo(bars: Dict[int, BarInfo], new_item: BarInfo) -> None:
+            bars[new_item.number] = new_item
 
-        for key in replay.get_keys():
+        for key in replay.iter_keys():
             key_index = get_key_index(key)
-            if key_index is None:
+            lane = BeatConvertedReplay.lane_of_key(key_index)
+            if lane is None:
+                self.unknown_keys += 1
                 continue
+            ms = key.get("time", 0)
 
             try:
                 if key["pressed"] is True:
                     if status[key_index].pressed is True:
-                        raise FailedParseReplay("duplication of press. ms={}, key_index={}".format(key["time"], key_index), __LINE__())
-                    status[key_index].bar, _ = calc_timing(key["time"])
+                        raise FailedParseReplay("duplication of press. ms={}, key_index={}".format(ms, key_index), __LINE__())
+                    status[key_index].bar, _ = calc_timing(ms)
                     status[key_index].pressed = True
-                    status[key_index].ms = key["time"]
+                    status[key_index].ms = ms
                     continue
             except KeyError:
                 # pressed False
                 pass
 
             threshold_value = 0
-            if is_scratch(key_index):
+            if is_scratch(lane):
                 threshold_value = threshold_scratch
             else:
                 threshold_value = threshold
 
             new_key_bar, new_key_timing = calc_timing(status[key_index].ms)
 
-            if (key["time"] - status[key_index].ms) <= threshold_value:
+            if (ms - status[key_index].ms) <= threshold_value:
                 target_bar = get_barinfo(result, new_key_bar)
                 new_key_input = Note()
                 new_key_input.timing = new_key_timing
-                target_bar.notes[key_index].append(new_key_input)
+                target_bar.notes[lane].append(new_key_input)
                 set_barinfo(result, target_bar)
 
                 status[key_index].bar = new_key_bar
                 status[key_index].pressed = False
-                status[key_index].ms = key["time"]
+                status[key_index].ms = ms
             else:
                 # LN
-                new_key_bar_end, new_key_timing_end = calc_timing(key["time"])
+                new_key_bar_end, new_key_timing_end = calc_timing(ms)
 
                 new_key_input_start = LNStart()
                 new_key_input_start.timing = new_key_timing
@@ -241,7 +342,7 @@ class BeatConvertedReplay():
                     new_key_input_ln.is_end = True
 
                     target_bar = get_barinfo(result, new_key_bar)
-                    target_bar.lnnotes[key_index].extend([ new_key_input_start, new_key_input_ln, new_key_input_end ])
+                    target_bar.lnnotes[lane].extend([ new_key_input_start, new_key_input_ln, new_key_input_end ])
                     set_barinfo(result, target_bar)
                 else:
                     new_key_input_ln = LN()
@@ -251,7 +352,7 @@ class BeatConvertedReplay():
                     new_key_input_ln.is_end = False
 
                     start_bar = get_barinfo(result, new_key_bar)
-                    start_bar.lnnotes[key_index].extend([ new_key_input_start, new_key_input_ln ])
+                    start_bar.lnnotes[lane].extend([ new_key_input_start, new_key_input_ln ])
                     set_barinfo(result, start_bar)
 
                     target_bar_number = new_key_bar + 1
@@ -264,7 +365,7 @@ class BeatConvertedReplay():
                             new_key_input_ln.is_end = False
 
                             target_bar = get_barinfo(result, target_bar_number)
-                            start_bar.lnnotes[key_index].append(target_bar)
+                            target_bar.lnnotes[lane].append(new_key_input_ln)
                             set_barinfo(result, target_bar)
                             target_bar_number += 1
                             continue
@@ -277,23 +378,140 @@ class BeatConvertedReplay():
                         new_key_input_ln.is_end = True
 
                         target_bar = get_barinfo(result, target_bar_number)
-                        target_bar.lnnotes[key_index].extend([ new_key_input_ln, new_key_input_end ])
+                        target_bar.lnnotes[lane].extend([ new_key_input_ln, new_key_input_end ])
                         set_barinfo(result, target_bar)
                         break
 
                 status[key_index].bar = new_key_bar_end
                 status[key_index].pressed = False
-                status[key_index].ms = key["time"]
+                status[key_index].ms = ms
+
+        self.bars = self.__fill_bars(bms, result)
+
+    def convert_batch(self, bms: BMS, replay: ReplayData, threshold: int = 100, threshold_scratch: int = 400):
+        """
+        same as convert, but whole keylog is paired and mapped to bars at once.
+        """
+        tempo = TempoMap.of(bms)
+        self.time_definition = tempo.segments
+
+        time, key_index, pressed = replay.get_key_arrays()
+        lanes = [ BeatConvertedReplay.lane_of_key(x) for x in range(10) ]
+        lane_of_key = np.asarray([ -1 if x is None else x for x in lanes ])
+        known = (key_index >= 0) & (key_index < len(lane_of_key))
+        known[known] = lane_of_key[key_index[known]] >= 0
+        self.unknown_keys = int(np.count_nonzero(~known))
+        time = time[known]
+        key_index = key_index[known]
+        pressed = pressed[known]
+
+        # each direction of scratch is paired separately, and both are lane 0
+        order = np.argsort(key_index, kind='stable')
+        time = time[order]
+        key_index = key_index[order]
+        pressed = pressed[order]
+
+        # each release is paired with the previous event of the lane
+        first = np.ones(len(time), dtype=bool)
+        first[1:] = key_index[1:] != key_index[:-1]
+        before_time = np.zeros(len(time), dtype=np.int64)
+        before_time[1:] = time[:-1]
+        before_time[first] = 0
+        before_pressed = np.zeros(len(time), dtype=bool)
+        before_pressed[1:] = pressed[:-1]
+        before_pressed[first] = False
+
+        duplication = pressed & before_pressed
+        if np.any(duplication):
+            i = np.argmax(duplication)
+            raise FailedParseReplay("duplication of press. ms={}, key_index={}".format(time[i], key_index[i]), __LINE__())
+
+        release = ~pressed
+        lane = lane_of_key[key_index[release]]
+        start = before_time[release]
+        end = time[release]
+        threshold_value = np.where(lane == 0, threshold_scratch, threshold)
+        is_ln = (end - start) > threshold_value
+
+        # presses are only checked that they are in the timeline
+        if np.any(time[pressed] < 0):
+            raise OutOfTimeline("no bar at {} ms".format(time[pressed].min()), __LINE__())
+        tap = ~is_ln
+        tap_bar, tap_timing = tempo.ms_to_timing_array(start[tap])
+        start_bar, start_timing = tempo.ms_to_timing_array(start[is_ln])
+        end_bar, end_timing = tempo.ms_to_timing_array(end[is_ln])
+
+        bars = dict() # Dict[int, BarInfo]
+        def get_barinfo(number: int) -> BarInfo:
+            try:
+                return bars[number]
+            except KeyError:
+                pass
+            bar = BarInfo().allocate()
+            bar.number = number
+            bars[number] = bar
+            return bar
 
-        for b in result:
-            b.sort()
+        for number, index, timing in zip(tap_bar.tolist(), lane[tap].tolist(), tap_timing):
+            new_key_input = Note()
+            new_key_input.timing = timing
+            get_barinfo(number).notes[index].append(new_key_input)
+
+        for number, index, timing, number_end, timing_end in zip(start_bar.tolist(), lane[is_ln].tolist(),
+            start_timing, end_bar.tolist(), end_timing):
+            new_key_input_start = LNStart()
+            new_key_input_start.timing = timing
+            new_key_input_end = LNEnd()
+            new_key_input_end.timing = timing_end
+
+            new_key_input_ln = LN()
+            new_key_input_ln.start = timing
+            new_key_input_ln.is_start = True
+            if number_end == number:
+                new_key_input_ln.end = timing_end
+                new_key_input_ln.is_end = True
+                get_barinfo(number).lnnotes[index].extend([ new_key_input_start, new_key_input_ln, new_key_input_end ])
+                continue
+            new_key_input_ln.end = 1
+            new_key_input_ln.is_end = False
+            get_barinfo(number).lnnotes[index].extend([ new_key_input_start, new_key_input_ln ])
+
+            for target_bar_number in range(number + 1, number_end + 1):
+                new_key_input_ln = LN()
+                new_key_input_ln.start = 0
+                new_key_input_ln.is_start = False
+                if target_bar_number != number_end:
+                    new_key_input_ln.end = 1
+                    new_key_input_ln.is_end = False
+                    get_barinfo(target_bar_number).lnnotes[index].append(new_key_input_ln)
+                    continue
+                new_key_input_ln.end = timing_end
+                new_key_input_ln.is_end = True
+                get_barinfo(target_bar_number).lnnotes[index].extend([ new_key_input_ln, new_key_input_end ])
 
-        self.bars = result
+        self.bars = self.__fill_bars(bms, bars)
+
+    def __fill_bars(self, bms: BMS, bars: Dict[int, BarInfo]) -> List[BarInfo]:
+        """
+        list of bars indexed by bar number. bars without input are blank.
+        """
+        count = max([ len(bms.bars) ] + [ x + 1 for x in bars.keys() ])
+        result = list()
+        for number in range(count):
+            try:
+                bar = bars[number]
+                bar.sort()
+            except KeyError:
+                bar = BarInfo()
+                bar.number = number
+            result.append(bar)
+        return result
 
 class ReplayNoteDrawer():
     def __init__(self, bar_height: int, key_size: KeySize=ModeSevenKeySize()):
         self.drawer = None
         self.bar_height = bar_height
+        self.resolution = 1
         self.key_size = key_size
         self.color = COLOR_PURPLE
 
@@ -303,10 +521,17 @@ class ReplayNoteDrawer():
     def set_height(self, height):
         self.bar_height = height
 
+    def set_resolution(self, resolution):
+        self.resolution = resolution
+
+    def __offset(self, timing):
+        # distance from the top of the bar
+        return (self.resolution - timing) * self.bar_height // self.resolution
+
     def __draw_note_implement(self, note, order, pos):
         x_start = pos[0]
         x_end = x_start + self.key_size.get_widths()[order] - 1
-        y_start = pos[1] + int((1 - note.timing) * self.bar_height) - self.key_size.get_height() - 1
+        y_start = pos[1] + self.__offset(note.timing) - self.key_size.get_height() - 1
         y_end = y_start + self.key_size.get_height()
         self.drawer.rectangle((x_start, y_start, x_end, y_end), outline=self.color, width=2)
 
@@ -317,20 +542,20 @@ class ReplayNoteDrawer():
     def __draw_note_ln_layer_start(self, note, order, pos):
         x_start = pos[0]
         x_end = x_start + self.key_size.get_widths()[order] - 1
-        y = pos[1] + int((1 - note.timing) * self.bar_height) - 1
+        y = pos[1] + self.__offset(note.timing) - 1
         self.drawer.line((x_start, y, x_end, y), fill=self.color, width=2)
 
     def __draw_note_ln_layer_end(self, note, order, pos):
         x_start = pos[0]
         x_end = x_start + self.key_size.get_widths()[order] - 1
-        y = pos[1] + int((1 - note.timing) * self.bar_height) - self.key_size.get_height() - 1
+        y = pos[1] + self.__offset(note.timing) - self.key_size.get_height() - 1
         self.drawer.line((x_start, y, x_end, y), fill=self.color, width=2)
 
     def __draw_note_ln_layer(self, note, order, pos):
         x_start = pos[0]
         x_end = x_start + self.key_size.get_widths()[order] - 1 - 1 # -1 because of width
-        y_start = pos[1] + int((1 - note.end) * self.bar_height) - self.key_size.get_height() - 1
-        y_end = pos[1] + int((1 - note.start) * self.bar_height) - 1
+        y_start = pos[1] + self.__offset(note.end) - self.key_size.get_height() - 1
+        y_end = pos[1] + self.__offset(note.start) - 1
         self.drawer.line((x_start, y_start, x_start, y_end), fill=self.color, width=2)
         self.drawer.line((x_end, y_start, x_end, y_end), fill=self.color, width=2)
 
@@ -343,115 +568,130 @@ class ReplayNoteDrawer():
             if isinstance(note, bms.LN):
                 self.__draw_note_ln_layer(note, order, pos)
 
+    def fill(self, canvas: ArrayCanvas, notes: NoteArray):
+        """
+        queue all notes to `canvas` in the same pixels as draw_note and draw_lnnote.
+        """
+        height = self.key_size.get_height()
+        x = notes.x
+        x_end = x + np.asarray(self.key_size.get_widths(), dtype=np.int64)[notes.order] - 1
+
+        note = notes.kind == NoteArray.NOTE
+        y = notes.y[note] - height - 1
+        canvas.outlines(x[note], y, x_end[note], y + height, self.color, 2, notes.seq[note])
+
+        start = notes.kind == NoteArray.LN_START
+        y = notes.y[start] - 1
+        canvas.lines(x[start], y, x_end[start], y, self.color, 2, notes.seq[start])
+        end = notes.kind == NoteArray.LN_END
+        y = notes.y[end] - height - 1
+        canvas.lines(x[end], y, x_end[end], y, self.color, 2, notes.seq[end])
+
+        ln = notes.kind == NoteArray.LN
+        y_start = notes.y[ln] - height - 1
+        y_end = notes.y_start[ln] - 1
+        canvas.lines(x[ln], y_start, x[ln], y_end, self.color, 2, notes.seq[ln])
+        canvas.lines(x_end[ln] - 1, y_start, x_end[ln] - 1, y_end, self.color, 2, notes.seq[ln])
+
 class ReplayImage(BMSImage):
     def __init__(self, bms: BMS, replay: List[BarInfo], style=None, replay_style=None, keymode: KeyMode=KeyMode.mode7key, keysize: KeySize=ModeSevenKeySize(),
-        line_width: int=1, bar_height: int=200, canvas_height: int=1000, width_offset: int=20, height_offset: int=50):
+        line_width: int=1, bar_height: int=200, canvas_height: int=1000, width_offset: int=20, height_offset: int=50, density=None):
         super().__init__(bms, style, keymode, keysize, line_width, bar_height,
-            canvas_height, width_offset, height_offset)
-        self.replay = replay
+            canvas_height, width_offset, height_offset, density)
+        self.replay = { x.number: x for x in replay } # Dict[int, BarInfo]
         if replay_style is not None:
             self.replay_style = replay_style
         else:
             self.replay_style = ReplayNoteDrawer(bar_height, keysize)
 
-    def _draw_notes(self, modify: List[int]=[0, 1, 2, 3, 4, 5, 6]):
-        dr = ImageDraw.Draw(self.image)
+    def _set_drawer(self, dr: ImageDraw.ImageDraw):
         self.style.set_drawer(dr)
         self.replay_style.set_drawer(dr)
 
-        cursor = [ self.width_offset, self.canvas.height - self.height_offset - 1 ]
-        for line in self.canvas.barlist:
-
-            def move_cursor(cr, order):
-                cr += self.keysize.get_widths()[order]
-                cr += self.line_width
-                return cr
-
-            def get_bar_from_replay(number) -> BarInfo:
-                i = next(filter(lambda x: x.number == number, self.replay))
-                return i
-
-            # draw bms notes
-
-            worker_cursor = copy(cursor)
-
-            for b in line:
-                bar_height = int(self.bar_height * b.beat)
-                self.style.set_height(bar_height)
-                note_cursor = copy(worker_cursor)
-                note_cursor[1] -= (bar_height - 1)
-
-                # draw bpm notes
+    def _tile_source(self, first: int, last: int) -> 'ReplayImage':
+        source = super()._tile_source(first, last)
+        source.replay_style = copy(self.replay_style)
+        source.replay_style.set_drawer(None)
+        numbers = [ x.number for line in self.canvas.barlist[first:last] for x in line ]
+        source.replay = { x: self.replay[x] for x in numbers if x in self.replay }
+        return source
+
+    def _replay_bar(self, number: int) -> BarInfo:
+        try:
+            return self.replay[number]
+        except KeyError:
+            # no input in the bar
+            bar = BarInfo()
+            bar.number = number
+            return bar
 
-                for bpm in b.bpm:
-                    y_bpm = note_cursor[1] + int((1 - bpm.timing) * bar_height) - 1
-                    dr.line((note_cursor[0], y_bpm, note_cursor[0] + self.__bar_width() - 2 * self.line_width - 1, y_bpm), \
-                        fill=(0, 255, 0), width=self.line_width*2)
-                    dr.text((note_cursor[0] + 2, y_bpm - 11), text=str(bpm.bpm), anchor='rs', fill=(0, 255, 0))
+    def _draw_line_notes(self, dr: ImageDraw.ImageDraw, line: List[BarInfo], x: int, modify: List[int]):
 
-                note_cursor[0] += self.line_width * 2
-                note_cursor[0] += self.info_width
-                self.style.draw_note(b.notes[0], 0, note_cursor)
-                self.style.draw_lnnote(b.lnnotes[0], 0, note_cursor)
+        def move_cursor(cr, order):
+            cr += self.keysize.get_widths()[order]
+            cr += self.line_width
+            return cr
 
-                for i, m in enumerate(modify):
-                    note_cursor[0] = move_cursor(note_cursor[0], i)
-                    self.style.draw_note(b.notes[m + 1], i + 1, note_cursor)
-                    self.style.draw_lnnote(b.lnnotes[m + 1], i + 1, note_cursor)
+        # draw bms notes
 
-                worker_cursor[1] -= bar_height
+        super()._draw_line_notes(dr, line, x, modify)
 
-            worker_cursor = copy(cursor)
+        worker_cursor = [ x, self.canvas.height - self.height_offset - 1 ]
 
-            # draw replay notes
-            for b in line:
-                bar_height = int(self.bar_height * b.beat)
-                self.replay_style.set_height(bar_height)
-                note_cursor = copy(worker_cursor)
-                note_cursor[1] -= (bar_height - 1)
+        # draw replay notes
+        for b in line:
+            bar_height = int(self.bar_height * b.beat)
+            self.replay_style.set_height(bar_height)
+            note_cursor = copy(worker_cursor)
+            note_cursor[1] -= (bar_height - 1)
 
-                replay_data = get_bar_from_replay(b.number)
+            replay_data = self._replay_bar(b.number)
+            self.replay_style.set_resolution(replay_data.resolution)
 
-                note_cursor[0] += self.line_width * 2
-                note_cursor[0] += self.info_width
+            note_cursor[0] += self.line_width * 2
+            note_cursor[0] += self.info_width
 
-                self.replay_style.draw_note(replay_data.notes[0], 0, note_cursor)
-                self.replay_style.draw_lnnote(replay_data.lnnotes[0], 0, note_cursor)
+            self.replay_style.draw_note(replay_data.notes[0], 0, note_cursor)
+            self.replay_style.draw_lnnote(replay_data.lnnotes[0], 0, note_cursor)
 
-                for i in range(7):
-                    note_cursor[0] = move_cursor(note_cursor[0], i)
-                    self.replay_style.draw_note(replay_data.notes[i + 1], i + 1, note_cursor)
-                    self.replay_style.draw_lnnote(replay_data.lnnotes[i + 1], i + 1, note_cursor)
+            for i in range(7):
+                note_cursor[0] = move_cursor(note_cursor[0], i)
+                self.replay_style.draw_note(replay_data.notes[i + 1], i + 1, note_cursor)
+                self.replay_style.draw_lnnote(replay_data.lnnotes[i + 1], i + 1, note_cursor)
 
-                worker_cursor[1] -= bar_height
+            worker_cursor[1] -= bar_height
 
-            cursor[0] += self._bar_width()
-            cursor[0] += self.width_offset
-            cursor[1] = self.canvas.height - self.height_offset - 1
+    def _fill_notes(self, canvas: ArrayCanvas, positions: List[Tuple[BarInfo, int, int, int]], modify: List[int]):
+        super()._fill_notes(canvas, positions, modify)
 
-    def draw(self, modify: List[int] = [0, 1, 2, 3, 4, 5, 6]):
-        self._calc_info_of_canvas()
-        self.image = Image.new("RGB", (self.canvas.width, self.canvas.height), (200, 200,200))
-        self._draw_bar_background()
-        self._draw_notes(modify)
+        # replay notes are drawn over the notes of BMS
+        canvas.next_layer()
+        positions = [ (self._replay_bar(b.number), height, top, left) for b, height, top, left in positions ]
+        self.replay_style.fill(canvas, NoteArray(positions, self._lane_x(0), list(range(8))))
 
 class Replay():
-    def __init__(self, file: str, db: str):
-        self.replay_data = ReplayData(file)
+    def __init__(self, file: str, db: str, timing_type: TimingType=TimingType.Fraction, cache: BMSCache=None, stream: bool=False):
+        self.replay_data = ReplayData(file, stream)
         file_sha256 = self.replay_data.get_file_sha256()
-        file_path = SongDB(db).get_file_path(file_sha256)
-        self.bms = BMS(file_path)
+        file_path = SongDB.of(db).get_file_path(file_sha256)
+        if cache is not None:
+            self.bms = cache.get(file_path, file_sha256, HashType.sha256, timing_type)
+        else:
+            self.bms = BMS(file_path, timing_type)
         self.convert = BeatConvertedReplay()
         self.image = None
 
-    def draw(self, threshold: int=100, threshold_scratch: int=400):
+    def draw(self, threshold: int=100, threshold_scratch: int=400, workers: Optional[int]=1):
         self.convert.convert(self.bms, self.replay_data, threshold, threshold_scratch)
         image = BMSImage(self.convert.bars)
-        image.draw()
+        image.draw(workers=workers)
         self.image = image.image
 
-    def draw_replay(self, threshold: int=100, threshold_scratch: int=400):
-        self.convert.convert(self.bms, self.replay_data, threshold, threshold_scratch)
+    def draw_replay(self, threshold: int=100, threshold_scratch: int=400, batch: bool=False, workers: Optional[int]=1):
+        if batch:
+            self.convert.convert_batch(self.bms, self.replay_data, threshold, threshold_scratch)
+        else:
+            self.convert.convert(self.bms, self.replay_data, threshold, threshold_scratch)
         image = ReplayImage(self.bms, self.convert.bars)
-        image.draw(modify=self.replay_data.get_pattern_modify())
+        image.draw(modify=self.replay_data.get_pattern_modify(), workers=workers, batch=batch)
         self.image = image.image
@@ -0,0 +1,201 @@
+from bisect import bisect_left, bisect_right
+from fractions import Fraction
+from math import floor
+from typing import List, Tuple
+
+import numpy as np
+
+from bms import BMS
+from common import *
+from oraplayexceptions import OutOfTimeline, __LINE__
+
+class TempoSegment():
+    def __init__(self, start_beat: Fraction=Fraction(0), start_ms: Fraction=Fraction(0), bpm: float=float()):
+        self.start_beat = start_beat # beats from the start of the chart
+        self.start_ms = start_ms
+        self.bpm = bpm
+
+class TempoMap():
+    """
+    conversion between ms, beats and positions (bar number, timing in the bar) of BMS.
+    a beat is a quarter note counted from the start of the chart, so a bar has 4 * bar.beat beats.
+    the chart is split into segments of constant BPM at each BPM change and STOP.
+    bars after the last one are 4/4.
+    use TempoMap.of(bms) to share the map built once per BMS.
+    """
+    def __init__(self, bms: BMS):
+        # bar_start_beats[n] is the sum of beats of bars before bar n
+        self.bar_start_beats = [ Fraction(0) ]
+        for bar in bms.bars:
+            self.bar_start_beats.append(self.bar_start_beats[-1] + bar.beat * 4)
+        self.segments = self.__make_segments(bms) # List[TempoSegment]
+
+        self.__start_beats = [ x.start_beat for x in self.segments ]
+        self.__start_ms = [ x.start_ms for x in self.segments ]
+        self.__ms_per_beat = [ ms_per_beat(x.bpm) for x in self.segments ]
+        self.__beat_per_ms = [ beat_per_ms(x.bpm) for x in self.segments ]
+        self.__array_start_beats = np.asarray([ float(x) for x in self.__start_beats ])
+        self.__array_start_ms = np.asarray([ float(x) for x in self.__start_ms ])
+        self.__array_ms_per_beat = np.asarray([ float(x) for x in self.__ms_per_beat ])
+        self.__array_beat_per_ms = np.asarray([ float(x) for x in self.__beat_per_ms ])
+        self.__array_bar_start_beats = np.asarray([ float(x) for x in self.bar_start_beats ])
+
+    @classmethod
+    def of(cls, bms: BMS) -> 'TempoMap':
+        """
+        TempoMap of `bms`, cached on it.
+        """
+        tempo = getattr(bms, 'tempo_map', None)
+        if tempo is None:
+            tempo = cls(bms)
+            bms.tempo_map = tempo
+        return tempo
+
+    def __make_segments(self, bms: BMS) -> List[TempoSegment]:
+        # (beat, 0, bpm) for BPM change and (beat, 1, beats) for STOP, BPM change is applied first
+        events = list()
+        for bar in bms.bars:
+            start = self.bar_start_beats[bar.number]
+            length = bar.beat * 4
+            for b in bar.bpm:
+                events.append((start + bar.to_fraction(b.timing) * length, 0, b.bpm))
+            for s in bar.stops:
+                # #STOP is counted in 1/192 of 4/4 bar regardless of the meter
+                events.append((start + bar.to_fraction(s.timing) * length, 1, s.duration * 4))
+        events.sort(key=lambda x: (x[0], x[1]))
+
+        result = [ TempoSegment(Fraction(0), Fraction(0), bms.bpm) ]
+        for beat, kind, value in events:
+            current = result[-1]
+            ms = current.start_ms + (beat - current.start_beat) * ms_per_beat(current.bpm)
+            if kind == 0:
+                if beat == current.start_beat and ms == current.start_ms:
+                    current.bpm = value
+                    continue
+                result.append(TempoSegment(beat, ms, value))
+            else:
+                result.append(TempoSegment(beat, ms + value * ms_per_beat(current.bpm), current.bpm))
+        return result
+
+    def __bar_start(self, number: int) -> Fraction:
+        last = len(self.bar_start_beats) - 1
+        if number <= last:
+            return self.bar_start_beats[number]
+        return self.bar_start_beats[last] + (number - last) * 4
+
+    def __bar_length(self, number: int) -> Fraction:
+        last = len(self.bar_start_beats) - 1
+        if number < last:
+            return self.bar_start_beats[number + 1] - self.bar_start_beats[number]
+        return Fraction(4)
+
+    def beat_to_ms(self, beat: Fraction) -> Fraction:
+        """
+        ms of the beat. a note on a STOP is played at the start of the STOP.
+        """
+        i = max(bisect_left(self.__start_beats, beat) - 1, 0)
+        return self.__start_ms[i] + (beat - self.__start_beats[i]) * self.__ms_per_beat[i]
+
+    def ms_to_beat(self, ms: Fraction) -> Fraction:
+        """
+        beat at the ms. beat does not move while STOP.
+        """
+        i = max(bisect_right(self.__start_ms, ms) - 1, 0)
+        beat = self.__start_beats[i] + (ms - self.__start_ms[i]) * self.__beat_per_ms[i]
+        if i + 1 < len(self.segments):
+            beat = min(beat, self.__start_beats[i + 1])
+        return beat
+
+    def beat_to_ms_array(self, beats: np.ndarray) -> np.ndarray:
+        beats = np.asarray(beats, dtype=np.float64)
+        i = np.maximum(np.searchsorted(self.__array_start_beats, beats, side='left') - 1, 0)
+        return self.__array_start_ms[i] + (beats - self.__array_start_beats[i]) * self.__array_ms_per_beat[i]
+
+    def ms_to_beat_array(self, ms: np.ndarray) -> np.ndarray:
+        ms = np.asarray(ms, dtype=np.float64)
+        i = np.maximum(np.searchsorted(self.__array_start_ms, ms, side='right') - 1, 0)
+        beats = self.__array_start_beats[i] + (ms - self.__array_start_ms[i]) * self.__array_beat_per_ms[i]
+        end = np.append(self.__array_start_beats[1:], np.inf)
+        return np.minimum(beats, end[i])
+
+    def position_to_beat(self, number: int, timing: Fraction) -> Fraction:
+        """
+        beat of `timing` (0 <= timing < 1) in bar `number`.
+        """
+        return self.__bar_start(number) + timing * self.__bar_length(number)
+
+    def beat_to_position(self, beat: Fraction) -> Tuple[int, Fraction]:
+        last = len(self.bar_start_beats) - 1
+        if beat >= self.bar_start_beats[last]:
+            number = last + floor((beat - self.bar_start_beats[last]) / 4)
+        else:
+            number = bisect_right(self.bar_start_beats, beat) - 1
+        return (number, (beat - self.__bar_start(number)) / self.__bar_length(number))
+
+    def position_to_beat_array(self, numbers: np.ndarray, timings: np.ndarray) -> np.ndarray:
+        numbers = np.asarray(numbers, dtype=np.int64)
+        last = len(self.bar_start_beats) - 1
+        inside = np.minimum(numbers, last)
+        start = self.__array_bar_start_beats[inside] + (numbers - inside) * 4
+        length = np.append(np.diff(self.__array_bar_start_beats), 4.0)[inside]
+        return start + np.asarray(timings, dtype=np.float64) * length
+
+    def beat_to_position_array(self, beats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        beats = np.asarray(beats, dtype=np.float64)
+        last = len(self.bar_start_beats) - 1
+        numbers = np.searchsorted(self.__array_bar_start_beats, beats, side='right') - 1
+        over = numbers >= last
+        numbers[over] = last + np.floor((beats[over] - self.__array_bar_start_beats[last]) / 4).astype(np.int64)
+        inside = np.minimum(numbers, last)
+        start = self.__array_bar_start_beats[inside] + (numbers - inside) * 4
+        length = np.append(np.diff(self.__array_bar_start_beats), 4.0)[inside]
+        return (numbers, (beats - start) / length)
+
+    def ms_to_timing(self, ms: int) -> Tuple[int, Fraction]:
+        """
+        position of the ms in bar number and timing in the bar (0 <= timing < 1).
+        """
+        if ms < 0:
+            raise OutOfTimeline("no bar at {} ms".format(ms), __LINE__())
+        return self.beat_to_position(self.ms_to_beat(ms))
+
+    def ms_to_timing_array(self, ms: np.ndarray) -> Tuple[np.ndarray, List[Fraction]]:
+        """
+        ms_to_timing of many ms at once.
+        bars are found by vectorized search, and timings are exactly same as ms_to_timing.
+        """
+        ms = np.asarray(ms, dtype=np.int64)
+        if np.any(ms < 0):
+            raise OutOfTimeline("no bar at {} ms".format(ms[np.argmax(ms < 0)]), __LINE__())
+        segment = np.maximum(np.searchsorted(self.__array_start_ms, ms, side='right') - 1, 0)
+        beats = self.ms_to_beat_array(ms)
+        numbers, timings_float = self.beat_to_position_array(beats)
+
+        # timing is ms * slope + offset in each pair of segment and bar
+        constants = dict() # Dict[Tuple[int, int], Tuple[Fraction, Fraction]]
+        def get_constant(s: int, n: int) -> Tuple[Fraction, Fraction]:
+            try:
+                return constants[(s, n)]
+            except KeyError:
+                pass
+            length = self.__bar_length(n)
+            slope = self.__beat_per_ms[s] / length
+            offset = (self.__start_beats[s] - self.__start_ms[s] * self.__beat_per_ms[s] - self.__bar_start(n)) / length
+            constants[(s, n)] = (slope, offset)
+            return constants[(s, n)]
+
+        # with one normalization
+        timings = list()
+        for m, s, n in zip(ms.tolist(), segment.tolist(), numbers.tolist()):
+            slope, offset = get_constant(s, n)
+            timings.append(Fraction(m * slope.numerator * offset.denominator + offset.numerator * slope.denominator,
+                slope.denominator * offset.denominator))
+
+        # float search may pick the next bar near the boundary, and beat does not move while STOP
+        end = np.append(self.__array_start_beats[1:], np.inf)[segment]
+        next_ms = np.append(self.__array_start_ms[1:], np.inf)[segment]
+        near = (timings_float < 1e-9) | (timings_float > 1 - 1e-9) | (beats >= end - 1e-9) | \
+            (np.abs(ms - self.__array_start_ms[segment]) < 1e-6) | (np.abs(ms - next_ms) < 1e-6)
+        for i in np.flatnonzero(near).tolist():
+            numbers[i], timings[i] = self.ms_to_timing(int(ms[i]))
+        return (numbers, timings)
@@ -0,0 +1,114 @@
+import gzip
+import json
+
+from bms import BMS
+from judge import JudgeType, ReplayJudge
+from replay import ReplayData, BeatConvertedReplay
+
+# 120 BPM, a bar is 2000 ms
+HEADER = "#BPM 120\n#LNTYPE 1\n"
+
+def make_bms(lines: str) -> BMS:
+    return BMS.from_bytes((HEADER + lines).encode('ascii'))
+
+def make_replay(tmp_path, keylog: list, randomoption: int=0) -> ReplayData:
+    """
+    keylog is a list of (keycode, ms, pressed).
+    """
+    events = list()
+    for keycode, ms, pressed in keylog:
+        event = { 'keycode': keycode, 'time': ms }
+        if pressed:
+            event['pressed'] = True
+        events.append(event)
+    path = tmp_path / "replay.gz"
+    with gzip.open(str(path), mode='wt') as fp:
+        json.dump({ 'sha256': '', 'randomoption': randomoption, 'pattern': [], 'keylog': events }, fp)
+    return ReplayData(str(path))
+
+def tap(keycode: int, ms: int) -> list:
+    return [ (keycode, ms, True), (keycode, ms + 30, False) ]
+
+def judge(bms: BMS, replay: ReplayData):
+    result = ReplayJudge(bms, replay).judge()
+    return result, result.counts()
+
+def test_windows(tmp_path):
+    # notes of key 1 at 0, 500, 1000 and 1500 ms
+    bms = make_bms("#00011:01010101\n")
+    replay = make_replay(tmp_path, tap(0, 0) + tap(0, 530) + tap(0, 1100) + tap(0, 1700))
+    result, counts = judge(bms, replay)
+    assert counts == { JudgeType.PGreat: 1, JudgeType.Great: 1, JudgeType.Good: 1, JudgeType.Bad: 1, JudgeType.Poor: 0 }
+    assert result.offset.tolist() == [ 0, 30, 100, 200 ]
+    assert result.ex_score() == 3
+    assert result.max_ex_score() == 8
+    assert result.empty_poor == 0
+
+def test_missed_note_and_empty_poor(tmp_path):
+    # notes at 0 and 1000 ms, the second is not hit and a press at 1500 ms hits no note
+    bms = make_bms("#00011:0101\n")
+    replay = make_replay(tmp_path, tap(0, 10) + tap(0, 1500))
+    result, counts = judge(bms, replay)
+    assert counts[JudgeType.PGreat] == 1
+    assert counts[JudgeType.Poor] == 1
+    assert result.empty_poor == 1
+    assert result.ex_score() == 2
+
+def test_nearest_note(tmp_path):
+    # notes at 0 and 250 ms, a press at 200 ms is judged on the nearer one
+    bms = make_bms("#00011:0101000000000000\n")
+    replay = make_replay(tmp_path, tap(0, 200))
+    result, counts = judge(bms, replay)
+    assert result.offset[0] != result.offset[0] # NaN, not hit
+    assert result.offset[1] == -50
+    assert counts[JudgeType.Great] == 1
+    assert counts[JudgeType.Poor] == 1
+
+def test_ln_end(tmp_path):
+    # LN of key 1 from 0 to 1000 ms
+    bms = make_bms("#00051:0101\n")
+    replay = make_replay(tmp_path, [ (0, 10, True), (0, 1050, False) ])
+    result, counts = judge(bms, replay)
+    assert counts[JudgeType.PGreat] == 1
+    assert counts[JudgeType.Great] == 1
+    assert result.ex_score() == 3
+    assert result.max_ex_score() == 4
+
+def test_ln_end_without_release(tmp_path):
+    bms = make_bms("#00051:0101\n")
+    replay = make_replay(tmp_path, [ (0, 0, True) ])
+    result, counts = judge(bms, replay)
+    assert counts[JudgeType.PGreat] == 1
+    assert counts[JudgeType.Poor] == 1
+    assert result.ex_score() == 2
+
+def test_both_scratch_keycodes(tmp_path):
+    # scratch at 0 and 1000 ms, hit by keycode 7 and keycode 8
+    bms = make_bms("#00016:0101\n")
+    replay = make_replay(tmp_path, tap(7, 0) + tap(8, 1010))
+    result, counts = judge(bms, replay)
+    assert counts[JudgeType.PGreat] == 2
+    assert result.ex_score() == 4
+    assert result.unknown_keys == 0
+
+    convert = BeatConvertedReplay()
+    convert.convert_batch(bms, replay)
+    assert len(convert.bars[0].notes[0]) == 2
+
+def test_mirror(tmp_path):
+    # a note of key 7 is hit by keycode 0 on Mirror
+    bms = make_bms("#00019:01\n")
+    result, counts = judge(bms, make_replay(tmp_path, tap(0, 0), randomoption=1))
+    assert counts[JudgeType.PGreat] == 1
+    assert result.empty_poor == 0
+
+    result, counts = judge(bms, make_replay(tmp_path, tap(0, 0), randomoption=0))
+    assert counts[JudgeType.Poor] == 1
+    assert result.empty_poor == 1
+
+def test_unknown_keys(tmp_path):
+    bms = make_bms("#00011:01\n")
+    replay = make_replay(tmp_path, tap(0, 0) + tap(9, 100))
+    result, counts = judge(bms, replay)
+    assert counts[JudgeType.PGreat] == 1
+    assert result.unknown_keys == 2